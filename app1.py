@@ -2,9 +2,10 @@
 # -*- mode: python ; coding: utf-8 -*-
 from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import os
+import shutil
 import sys
 import logging
 import smtplib
@@ -14,15 +15,21 @@ from email.mime.base import MIMEBase
 from email import encoders
 from werkzeug.utils import secure_filename
 import json
+import re
 import secrets
 import hashlib
 import bcrypt
 import socket
 import uuid
+import zlib
 import time
 import threading
 import traceback
 from functools import wraps
+from collections import OrderedDict
+from itertools import chain, islice
+import heapq
+from contextlib import contextmanager
 import jwt
 import requests
 from io import BytesIO
@@ -37,6 +44,15 @@ try:
 except ImportError:
     schedule = None
     logging.warning("schedule library not found. Automatic tasks will be disabled.")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    logging.info("orjson library not found. Falling back to the standard json module.")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 # SQLite import
 import sqlite3
 # --- Configuration Management ---
@@ -108,191 +124,2457 @@ def create_directory(directory):
         logger.error(f"Error creating directory {directory}: {e}")
 create_directory(app.config['UPLOAD_FOLDER'])
 conn = None
+# --- JSON codec ---
+def json_default(value):
+    """Serializes the non-JSON types documents may carry (datetimes, dates, sets)."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+if orjson is not None:
+    def dumps_json(value):
+        return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    loads_json = orjson.loads
+else:
+    def dumps_json(value):
+        return json.dumps(value, default=json_default)
+    loads_json = json.loads
+def dumps_json_args(value, default=json_default, sort_keys=False, indent=None, separators=None, ensure_ascii=True, **kwargs):
+    """dumps_json taking json.dumps() arguments, for Flask; orjson writes the same JSON up to whitespace and escaping.
+
+    Falls back to json.dumps when orjson is missing or cannot lay the output out as asked."""
+    if orjson is None or kwargs or indent not in (None, 2):
+        return json.dumps(value, default=default, sort_keys=sort_keys, indent=indent, separators=separators, ensure_ascii=ensure_ascii, **kwargs)
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+    return orjson.dumps(value, default=default, option=option).decode('utf-8')
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
+if DefaultJSONProvider is not None:
+    class CodecJSONProvider(DefaultJSONProvider):
+        """Flask JSON provider backed by the codec, so jsonify encodes like storage does.
+
+        Types json_default() does not know go to Flask's own default (UUIDs, dataclasses, __html__)."""
+        def dumps(self, obj, **kwargs):
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            return dumps_json_args(obj, self.codec_default, **kwargs)
+
+        def codec_default(self, o):
+            try:
+                return json_default(o)
+            except TypeError:
+                return self.default(o)
+
+        def loads(self, s, **kwargs):
+            return loads_json(s)
+    app.json_provider_class = CodecJSONProvider
+    app.json = CodecJSONProvider(app)
+else:
+    from flask.json import JSONEncoder as FlaskJSONEncoder
+
+    class CodecJSONEncoder(FlaskJSONEncoder):
+        """Flask 2.1 encoder backed by the codec; Flask's own default still handles the types json_default() does not."""
+        def default(self, o):
+            try:
+                return json_default(o)
+            except TypeError:
+                return super().default(o)
+
+        def encode(self, o):
+            return dumps_json_args(o, self.default, sort_keys=self.sort_keys, indent=self.indent, ensure_ascii=self.ensure_ascii)
+    app.json_encoder = CodecJSONEncoder
+# --- Storage format ---
+# Documents are stored as JSON text, or as SQLite's binary JSONB (3.45+) when config.json sets
+# "storage_format": "jsonb". ensure_storage_format() converts existing rows once when the format changes.
+SQLITE_HAS_JSONB = sqlite3.sqlite_version_info >= (3, 45, 0)
+STORAGE_FORMAT = 'text'
+def doc_param():
+    """SQL placeholder for a document passed as JSON text, converted to the storage format."""
+    return 'jsonb(?)' if STORAGE_FORMAT == 'jsonb' else '?'
+def doc_text(column='data'):
+    """SQL expression reading a stored document back as JSON text."""
+    return f'json({column})' if STORAGE_FORMAT == 'jsonb' else column
+def json_writer(name):
+    """Name of the SQL JSON function (set, remove, object, ...) that builds values in the storage format."""
+    return f'jsonb_{name}' if STORAGE_FORMAT == 'jsonb' else f'json_{name}'
+def ensure_storage_format(conn, tables, requested='text'):
+    """Selects the storage format and converts every stored row the first time it changes."""
+    global STORAGE_FORMAT
+    if requested == 'jsonb' and not SQLITE_HAS_JSONB:
+        logger.warning(f"JSONB storage needs SQLite 3.45+, found {sqlite3.sqlite_version}; storing JSON text")
+        requested = 'text'
+    conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)")
+    row = conn.execute("SELECT value FROM storage_meta WHERE key = 'storage_format'").fetchone()
+    current = row[0] if row else 'text'
+    if current == 'jsonb' and not SQLITE_HAS_JSONB:
+        raise RuntimeError(f"restaurant.db stores JSONB documents, which SQLite {sqlite3.sqlite_version} cannot read")
+    if current != requested:
+        convert_storage_format(conn, tables, requested)
+    STORAGE_FORMAT = requested
+    return requested
+def convert_storage_format(conn, tables, target):
+    """Rewrites every document of tables as JSONB (target='jsonb') or JSON text (target='text') in one transaction.
+
+    The monthly archives are converted first, one file per transaction; the live tables and the recorded
+    format follow last, so an interrupted run is finished by the next start."""
+    convert, source_type = ('jsonb', 'text') if target == 'jsonb' else ('json', 'blob')
+    archived = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_catalog'").fetchone():
+        for table, months in load_archive_catalog(conn).items():
+            for month in months:
+                archived.setdefault(month, []).append(table)
+    for month, archived_tables in sorted(archived.items()):
+        schema = archive_schema(month)
+        if not conn.attach(archive_path(month, conn.archive_dir), schema):
+            raise RuntimeError(f"Could not attach the {month} archive to convert it to {target}")
+        with conn.transaction(archives=False):
+            for table in archived_tables:
+                cur = conn.execute(f"UPDATE {schema}.{table} SET data = {convert}(data) WHERE typeof(data) = ?", (source_type,))
+                logger.info(f"Converted {max(cur.rowcount, 0)} archived {month} {table} documents to {target}")
+    with conn.transaction(archives=False):
+        for table in tables:
+            cur = conn.execute(f"UPDATE {table} SET data = {convert}(data) WHERE typeof(data) = ?", (source_type,))
+            logger.info(f"Converted {max(cur.rowcount, 0)} {table} documents to {target}")
+        conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('storage_format', ?)", (target,))
+# --- Filter compilation (Mongo-style filter dict -> SQL WHERE clause) ---
+def json_path(key):
+    """Converts a dotted field name ('items.0.quantity') into a SQLite JSON path ('$.items[0].quantity')."""
+    parts = key.split('.') if isinstance(key, str) else list(key)
+    path = '$'
+    for part in parts:
+        if part.isdigit():
+            path += f'[{part}]'
+        elif part.isidentifier():
+            path += f'.{part}'
+        else:
+            path += f'."{part}"'
+    return path
+def sql_literal(text):
+    return "'" + text.replace("'", "''") + "'"
+def json_field_sql(key, source='data'):
+    return f"json_extract({source}, {sql_literal(json_path(key))})"
+def path_values(doc, parts):
+    """Yields every value reachable through parts, descending into arrays on intermediate segments."""
+    if not parts:
+        yield doc
+        return
+    part, rest = parts[0], parts[1:]
+    if isinstance(doc, dict):
+        if part in doc:
+            yield from path_values(doc[part], rest)
+    elif isinstance(doc, list):
+        if part.isdigit():
+            if int(part) < len(doc):
+                yield from path_values(doc[int(part)], rest)
+        else:
+            for element in doc:
+                if isinstance(element, dict):
+                    yield from path_values(element, parts)
+def path_condition(parts, predicate, source='data', depth=0):
+    """Builds a SQL condition that holds when predicate(source, path) holds for some value at the dotted path.
+
+    Intermediate arrays are searched with json_each, mirroring path_values(); the plain
+    json_extract branch comes first so single-field lookups can still use an expression index."""
+    sql, params = predicate(source, sql_literal(json_path(parts)))
+    branches, all_params = [sql], list(params)
+    for i in range(1, len(parts)):
+        if parts[i].isdigit():
+            continue
+        alias = f"je{depth}"
+        prefix = sql_literal(json_path(parts[:i]))
+        inner_sql, inner_params = path_condition(parts[i:], predicate, f"{alias}.value", depth + 1)
+        branches.append(
+            f"(json_type({source}, {prefix}) = 'array' AND EXISTS (SELECT 1 FROM json_each({source}, {prefix}) AS {alias} "
+            f"WHERE {alias}.type = 'object' AND {inner_sql}))"
+        )
+        all_params.extend(inner_params)
+    if len(branches) == 1:
+        return sql, all_params
+    return '(' + ' OR '.join(branches) + ')', all_params
+FILTER_COMPARISONS = {
+    '$gt': ('>', lambda a, b: a > b),
+    '$gte': ('>=', lambda a, b: a >= b),
+    '$lt': ('<', lambda a, b: a < b),
+    '$lte': ('<=', lambda a, b: a <= b),
+}
+NEGATED_OPERATORS = {'$ne': '$eq', '$nin': '$in'}
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+def is_sql_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+def is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith('$') for k in value)
+def filter_operand(value):
+    """Normalises a filter operand the way documents are stored, so datetimes compare as ISO strings."""
+    return document_to_dict(value)
+def equality_predicate(value):
+    if value is None:
+        return lambda source, path: (f"json_extract({source}, {path}) IS NULL", [])
+    return lambda source, path: (f"json_extract({source}, {path}) = ?", [value])
+def operator_predicate(op, operand):
+    """Returns predicate(source, path) for a positive operator, or None when it cannot run in SQL."""
+    if op == '$eq':
+        return equality_predicate(operand) if is_sql_scalar(operand) else None
+    if op in FILTER_COMPARISONS:
+        # Compare within one JSON type only, as MongoDB does (SQLite would otherwise order numbers before text).
+        if isinstance(operand, str):
+            json_types = "'text'"
+        elif is_number(operand):
+            json_types = "'integer', 'real'"
+        else:
+            return None
+        sign = FILTER_COMPARISONS[op][0]
+        return lambda source, path: (
+            f"(json_extract({source}, {path}) {sign} ? AND json_type({source}, {path}) IN ({json_types}))", [operand]
+        )
+    if op == '$in':
+        if not isinstance(operand, (list, tuple)) or not all(is_sql_scalar(v) for v in operand):
+            return None
+        values = [v for v in operand if v is not None]
+        def predicate(source, path):
+            expr = f"json_extract({source}, {path})"
+            terms = []
+            if values:
+                terms.append(f"{expr} IN ({', '.join(['?'] * len(values))})")
+            if len(values) != len(operand):
+                terms.append(f"{expr} IS NULL")
+            return '(' + (' OR '.join(terms) or '0') + ')', list(values)
+        return predicate
+    if op == '$exists':
+        return lambda source, path: (f"json_type({source}, {path}) IS NOT NULL", [])
+    return None
+def compile_condition(key, value, nested_source='data'):
+    """Compiles a single field condition into (sql, params), or None when it has to be checked in Python.
+
+    Dotted paths read the document from nested_source; top-level fields always use `data` so they
+    match the expression indexes."""
+    parts = key.split('.')
+    source = nested_source if len(parts) > 1 else 'data'
+    if not is_operator_dict(value):
+        return value_condition(parts, '$eq', filter_operand(value), source)
+    clauses, params = [], []
+    for op, operand in value.items():
+        operand = filter_operand(operand)
+        negate = op in NEGATED_OPERATORS or (op == '$exists' and not operand)
+        compiled = value_condition(parts, NEGATED_OPERATORS.get(op, op), operand, source)
+        if compiled is None:
+            return None
+        sql, op_params = compiled
+        clauses.append(f"NOT IFNULL({sql}, 0)" if negate else sql)
+        params.extend(op_params)
+    return ' AND '.join(clauses), params
+def value_condition(parts, op, operand, source='data'):
+    """Compiles one positive operator on a path into (sql, params), or None when it cannot run in SQL.
+
+    A null test matches a null value or a path that reaches nothing, as eq_test() does. On dotted paths
+    both are spelled out, since json_extract() is also NULL where the path runs through an array."""
+    predicate = operator_predicate(op, operand)
+    if predicate is None:
+        return None
+    values = [operand] if op == '$eq' else operand if op == '$in' else []
+    if len(parts) == 1 or None not in values:
+        return path_condition(parts, predicate, source)
+    terms, params = [], []
+    values = [v for v in values if v is not None]
+    if values:
+        sql, params = path_condition(parts, operator_predicate('$in', values), source)
+        terms.append(sql)
+    terms.append(path_condition(parts, lambda source, path: (f"json_type({source}, {path}) = 'null'", []), source)[0])
+    terms.append('NOT ' + path_condition(parts, operator_predicate('$exists', True), source)[0])
+    return '(' + ' OR '.join(terms) + ')', params
+def column_condition(column, key, value):
+    """Compiles string $eq/$in/comparison conditions on a TEXT generated column so they can use its index.
+
+    The column's TEXT affinity turns stored numbers into text, so the JSON type is still checked.
+    Returns None for any other condition."""
+    conditions = value.items() if is_operator_dict(value) else [('$eq', value)]
+    clauses, params = [], []
+    for op, operand in conditions:
+        operand = filter_operand(operand)
+        if op in ('$eq', *FILTER_COMPARISONS) and isinstance(operand, str):
+            clauses.append(f"{column} {'=' if op == '$eq' else FILTER_COMPARISONS[op][0]} ?")
+            params.append(operand)
+        elif op == '$in' and isinstance(operand, (list, tuple)) and operand and all(isinstance(v, str) for v in operand):
+            clauses.append(f"{column} IN ({', '.join(['?'] * len(operand))})")
+            params.extend(operand)
+        else:
+            return None
+    clauses.append(f"json_type(data, {sql_literal(json_path(key))}) = 'text'")
+    return ' AND '.join(clauses), params
+def compile_id_condition(value):
+    """Compiles string _id conditions against the `id` primary key column instead of the JSON body."""
+    conditions = value.items() if is_operator_dict(value) else [('$eq', value)]
+    clauses, params = [], []
+    for op, operand in conditions:
+        if op in ('$eq', '$ne') and isinstance(operand, str):
+            clauses.append('id = ?' if op == '$eq' else 'id != ?')
+            params.append(operand)
+        elif op in ('$in', '$nin') and isinstance(operand, (list, tuple)) and all(isinstance(v, str) for v in operand):
+            if operand:
+                clauses.append(f"id {'IN' if op == '$in' else 'NOT IN'} ({', '.join(['?'] * len(operand))})")
+                params.extend(operand)
+            else:
+                clauses.append('0' if op == '$in' else '1')
+        else:
+            return None
+    return ' AND '.join(clauses), params
+def compile_filter(filter_, nested_source='data', columns=None):
+    """Splits a filter into SQL clauses plus a residual filter that must be matched in Python.
+
+    Returns (clauses, params, residual). The clauses are ANDed together and select a superset
+    of the matching rows; residual is None when SQL alone decides the match. columns maps
+    top-level fields to indexed generated columns (see filter_columns()) that string conditions use."""
+    clauses, params, residual = [], [], {}
+    for key, value in (filter_ or {}).items():
+        if key == '$or':
+            branches, branch_params = [], []
+            for subfilter in value:
+                sub_clauses, sub_params, sub_residual = compile_filter(subfilter, nested_source, columns)
+                if sub_residual:
+                    break
+                branches.append(' AND '.join(sub_clauses) or '1')
+                branch_params.extend(sub_params)
+            else:
+                clauses.append('(' + (' OR '.join(f'({b})' for b in branches) or '0') + ')')
+                params.extend(branch_params)
+                continue
+            residual[key] = value
+            continue
+        if key == '$and':
+            for subfilter in value:
+                sub_clauses, sub_params, sub_residual = compile_filter(subfilter, nested_source, columns)
+                clauses.extend(sub_clauses)
+                params.extend(sub_params)
+                if sub_residual:
+                    residual.setdefault('$and', []).append(sub_residual)
+            continue
+        if key.startswith('$'):
+            compiled = None
+        elif key == '_id':
+            compiled = compile_id_condition(value) or compile_condition(key, value, nested_source)
+        elif columns and key in columns:
+            compiled = column_condition(columns[key], key, value) or compile_condition(key, value, nested_source)
+        else:
+            compiled = compile_condition(key, value, nested_source)
+        if compiled is None:
+            residual[key] = value
+            continue
+        clauses.append(compiled[0])
+        params.extend(compiled[1])
+    return clauses, params, residual or None
+DEFAULT_BATCH_SIZE = 500
+def iter_rows(cur, batch_size):
+    """Streams rows from a sqlite3 cursor in fetchmany() batches so only one batch is held at a time."""
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+def where_sql(clauses):
+    return " WHERE " + " AND ".join(clauses) if clauses else ''
+def sort_sql(sort):
+    """Compiles [(field, direction), ...] into an ORDER BY on the JSON fields (the id column for _id)."""
+    if not sort:
+        return ''
+    terms = []
+    for field, direction in sort:
+        expr = 'id' if field == '_id' else json_field_sql(field)
+        terms.append(f"{expr} {'DESC' if direction < 0 else 'ASC'}")
+    return " ORDER BY " + ", ".join(terms)
+# --- Field projection ---
+# The -> operator (SQLite 3.38+) returns a typed JSON fragment; older builds fall back to projecting in Python.
+SQLITE_HAS_JSON_ARROW = sqlite3.sqlite_version_info >= (3, 38, 0)
+def parse_projection(projection):
+    """Normalises a Mongo-style projection into (mode, fields, include_id).
+
+    mode is 'include' with a nested field tree, 'exclude' with a list of dotted paths, or None
+    when every field is kept. A list of field names is treated as an inclusion projection."""
+    if projection is None:
+        return None
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = bool(projection.get('_id', 1))
+    included = [k for k, v in projection.items() if k != '_id' and v]
+    excluded = [k for k, v in projection.items() if k != '_id' and not v]
+    if included and excluded:
+        raise ValueError("Projection cannot mix inclusion and exclusion")
+    if excluded:
+        return 'exclude', excluded, include_id
+    if not included:
+        return None, None, include_id
+    tree = {}
+    for field in included:
+        node, parts = tree, field.split('.')
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is True:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = True
+    return 'include', tree, include_id
+def projection_sql(tree, source='data', depth=0):
+    """Builds a json_object() expression holding the fields in tree that exist; arrays are projected element-wise.
+
+    As in MongoDB, missing fields are left out rather than returned as null, and a nested projection
+    keeps only the object elements of an array. json_object() cannot skip a key, so every key is
+    built and json_remove() then drops the missing ones; present keys get a path that never exists."""
+    args, removals = [], []
+    absent = sql_literal(json_path(['#' * (max(map(len, tree)) + 1)]))
+    for key, subtree in tree.items():
+        path = sql_literal(json_path([key]))
+        if subtree is True:
+            value = f"({source} -> {path})"
+            removals.append(f"CASE WHEN json_type({source}, {path}) IS NULL THEN {path} ELSE {absent} END")
+        else:
+            alias = f"jp{depth}"
+            element = projection_sql(subtree, f"{alias}.value", depth + 1)
+            nested = projection_sql(subtree, f"({source} -> {path})", depth + 1)
+            value = (
+                f"CASE json_type({source}, {path}) "
+                f"WHEN 'array' THEN (SELECT json_group_array({element}) "
+                f"FROM json_each({source}, {path}) AS {alias} WHERE {alias}.type = 'object') "
+                f"WHEN 'object' THEN {nested} END"
+            )
+            removals.append(f"CASE json_type({source}, {path}) WHEN 'array' THEN {absent} WHEN 'object' THEN {absent} ELSE {path} END")
+        args.append(f"{sql_literal(key)}, {value}")
+    return f"json_remove(json_object({', '.join(args)}), {', '.join(removals)})"
+def project_tree(value, tree):
+    """Python counterpart of projection_sql(): missing fields and non-object array elements are left out."""
+    projected = {}
+    for key, subtree in tree.items():
+        if key not in value:
+            continue
+        field = value[key]
+        if subtree is True:
+            projected[key] = field
+        elif isinstance(field, list):
+            projected[key] = [project_tree(element, subtree) for element in field if isinstance(element, dict)]
+        elif isinstance(field, dict):
+            projected[key] = project_tree(field, subtree)
+    return projected
+def remove_path(value, parts):
+    if isinstance(value, list):
+        for element in value:
+            remove_path(element, parts)
+    elif isinstance(value, dict):
+        if len(parts) == 1:
+            value.pop(parts[0], None)
+        elif parts[0] in value:
+            remove_path(value[parts[0]], parts[1:])
+def apply_projection(doc, spec):
+    mode, fields, include_id = spec
+    if mode == 'include':
+        projected = project_tree(doc, fields)
+        if include_id and '_id' in doc:
+            projected = {'_id': doc['_id'], **projected}
+        return projected
+    if mode == 'exclude':
+        for field in fields:
+            remove_path(doc, field.split('.'))
+    if not include_id:
+        doc.pop('_id', None)
+    return doc
+def projection_column(spec):
+    """Returns the SQL expression that yields the projected document, or None if it must be done in Python."""
+    mode, fields, _ = spec
+    if mode == 'include' and SQLITE_HAS_JSON_ARROW:
+        return projection_sql(fields)
+    if mode == 'exclude' and all('.' not in field for field in fields):
+        return f"json_remove({doc_text()}, {', '.join(sql_literal(json_path(field)) for field in fields)})"
+    if mode is None:
+        return doc_text()
+    return None
+FILTER_MATCHER_CACHE_SIZE = 1024
+FILTER_MATCHERS = {}
+def filter_shape(filter_, operands):
+    """Returns a hashable shape of filter_ (fields and operators), appending its operand values to operands."""
+    shape = []
+    for key, value in filter_.items():
+        if key in ('$or', '$and'):
+            shape.append((key, tuple(filter_shape(subfilter, operands) for subfilter in value)))
+        elif key.startswith('$'):
+            raise ValueError(f"Unsupported filter operator: {key}")
+        else:
+            conditions = value.items() if is_operator_dict(value) else [('$eq', value)]
+            ops = []
+            for op, operand in conditions:
+                ops.append(op)
+                operands.append(filter_operand(operand))
+            shape.append((key, tuple(ops)))
+    return tuple(shape)
+MISSING = object()
+def eq_test(operand):
+    if operand is None:
+        return lambda value: value is None or value is MISSING
+    return lambda value: value == operand
+def comparison_test(compare):
+    def make(operand):
+        if isinstance(operand, str):
+            return lambda value: isinstance(value, str) and compare(value, operand)
+        if is_number(operand):
+            return lambda value: is_number(value) and compare(value, operand)
+        return lambda value: False
+    return make
+def in_test(operand):
+    candidates = [o for o in operand if o is not None]
+    has_none = len(candidates) != len(operand)
+    try:
+        lookup = frozenset(candidates)
+    except TypeError:
+        lookup = candidates
+    def test(value):
+        if value is None or value is MISSING:
+            return has_none
+        try:
+            return value in lookup
+        except TypeError:
+            return value in candidates
+    return test
+def exists_test(operand):
+    return lambda value: (value is not MISSING) == bool(operand)
+OPERATOR_TESTS = {
+    '$eq': eq_test,
+    '$in': in_test,
+    '$exists': exists_test,
+    **{op: comparison_test(compare) for op, (_, compare) in FILTER_COMPARISONS.items()},
+}
+def field_matcher(key, op):
+    """Resolves one field condition into make(operand) -> predicate(doc), the Python counterpart of compile_condition().
+
+    Tests get MISSING for an absent field. Dotted paths test every value path_values() reaches, and
+    negated operators wrap the whole field, as NOT IFNULL(...) does in SQL."""
+    make_test = OPERATOR_TESTS.get(NEGATED_OPERATORS.get(op, op))
+    if make_test is None:
+        raise ValueError(f"Unsupported filter operator: {op}")
+    parts = key.split('.')
+    negate = op in NEGATED_OPERATORS
+    def make(operand):
+        test = make_test(operand)
+        if len(parts) == 1:
+            predicate = lambda d: test(d.get(key, MISSING))
+        else:
+            def predicate(d):
+                found = False
+                for value in path_values(d, parts):
+                    if test(value):
+                        return True
+                    found = True
+                return not found and test(MISSING)
+        if negate:
+            return lambda d: not predicate(d)
+        return predicate
+    return make
+def build_matcher(shape):
+    """Compiles a filter shape into make(operands) -> predicate(doc), consuming operands in filter order."""
+    makers = []
+    for key, ops in shape:
+        if key in ('$or', '$and'):
+            makers.append((any if key == '$or' else all, [build_matcher(subshape) for subshape in ops]))
+        else:
+            makers.extend((None, field_matcher(key, op)) for op in ops)
+    def make(operands):
+        predicates = []
+        for combine, maker in makers:
+            if combine is not None:
+                branches = [branch(operands) for branch in maker]
+                predicates.append(lambda d, branches=branches, combine=combine: combine(branch(d) for branch in branches))
+            else:
+                predicates.append(maker(next(operands)))
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda d: all(predicate(d) for predicate in predicates)
+    return make
+def compile_matcher(filter_):
+    """Returns predicate(doc) for filter_; compiled matchers are memoized by filter shape and reused across calls."""
+    if not filter_:
+        return lambda d: True
+    operands = []
+    shape = filter_shape(filter_, operands)
+    make = FILTER_MATCHERS.get(shape)
+    if make is None:
+        if len(FILTER_MATCHERS) >= FILTER_MATCHER_CACHE_SIZE:
+            FILTER_MATCHERS.clear()
+        make = FILTER_MATCHERS[shape] = build_matcher(shape)
+    return make(iter(operands))
+def document_matches(d, filter_):
+    return compile_matcher(filter_)(d)
+# --- Update operators ---
+IN_PLACE_UPDATE_OPERATORS = ('$set', '$unset', '$inc')
+def compile_update(update, source='data'):
+    """Compiles $set/$unset/$inc on top-level fields into one json_set(json_remove(source, ...), ...) expression.
+
+    Returns (sql_expression, params), or None when the update needs the Python path
+    (dotted or positional paths, $pull, array filters, non-numeric increments)."""
+    if not update or any(op not in IN_PLACE_UPDATE_OPERATORS for op in update):
+        return None
+    fields = [key for op in update.values() for key in op]
+    if len(set(fields)) != len(fields) or any('.' in key or key.startswith('$') for key in fields):
+        return None
+    expr, params, set_args = source, [], []
+    unset = list(update.get('$unset', {}))
+    if unset:
+        expr = f"{json_writer('remove')}({source}, {', '.join(sql_literal(json_path(key)) for key in unset)})"
+    for key, value in update.get('$set', {}).items():
+        set_args.append(f"{sql_literal(json_path(key))}, json(?)")
+        params.append(dumps_json(value))
+    for key, value in update.get('$inc', {}).items():
+        if not is_number(value):
+            return None
+        path = sql_literal(json_path(key))
+        set_args.append(f"{path}, COALESCE(json_extract({source}, {path}), 0) + ?")
+        params.append(value)
+    if set_args:
+        expr = f"{json_writer('set')}({expr}, {', '.join(set_args)})"
+    return expr, params
+def non_numeric_condition(update, source='data'):
+    """SQL condition matching documents where a $inc target holds a non-numeric value, or None without $inc.
+
+    SQLite would coerce such values ('5' + 1 = 6); those documents take the Python path, which raises TypeError."""
+    paths = [sql_literal(json_path(key)) for key in update.get('$inc', {})]
+    if not paths:
+        return None
+    return ' OR '.join(f"json_type({source}, {path}) NOT IN ('integer', 'real')" for path in paths)
+def resolve_positional(key, d, filter_):
+    """Replaces the positional '$' in key with the index of the first array element matched by filter_."""
+    if '.$.' not in key and not key.endswith('.$'):
+        return key
+    prefix = key.split('.$', 1)[0]
+    conditions = {k[len(prefix) + 1:]: v for k, v in (filter_ or {}).items() if k.startswith(prefix + '.')}
+    array = next(path_values(d, prefix.split('.')), None)
+    if not conditions or not isinstance(array, list):
+        return None
+    for index, element in enumerate(array):
+        if isinstance(element, dict) and document_matches(element, conditions):
+            return key.replace('.$', f'.{index}', 1)
+    return None
+def parent_for_path(d, parts, create):
+    """Walks to the container holding the last path segment, creating missing objects when create is set."""
+    current = d
+    for part in parts[:-1]:
+        if isinstance(current, list):
+            current = current[int(part)]
+        elif part in current:
+            current = current[part]
+        elif create:
+            current = current.setdefault(part, {})
+        else:
+            return None
+    return current
+def container_key(container, part):
+    return int(part) if isinstance(container, list) else part
+def apply_update(d, update, filter_=None, array_filters=None):
+    """Applies $set/$unset/$inc/$pull, including the '$' and '$[elem]' array operators, to d in place."""
+    for k, v in update.get('$set', {}).items():
+        if '$[elem]' in k:
+            continue
+        k = resolve_positional(k, d, filter_)
+        if k is None:
+            continue
+        parts = k.split('.')
+        parent = parent_for_path(d, parts, True)
+        parent[container_key(parent, parts[-1])] = v
+    for k in update.get('$unset', {}):
+        parts = k.split('.')
+        parent = parent_for_path(d, parts, False)
+        if isinstance(parent, dict):
+            parent.pop(parts[-1], None)
+        elif isinstance(parent, list):
+            parent[int(parts[-1])] = None
+    for k, v in update.get('$inc', {}).items():
+        parts = k.split('.')
+        parent = parent_for_path(d, parts, True)
+        key = container_key(parent, parts[-1])
+        parent[key] = (parent[key] if isinstance(parent, list) else parent.get(key, 0)) + v
+    for k, v in update.get('$pull', {}).items():
+        if isinstance(d.get(k), list):
+            d[k] = [i for i in d[k] if i != v]
+    if array_filters:
+        for uk, uv in update.get('$set', {}).items():
+            if '$[elem]' in uk:
+                array_name, rest = uk.split('.$[elem].', 1)
+                array = d.get(array_name, [])
+                af = array_filters[0]
+                af_key = list(af.keys())[0].split('.')[-1]
+                af_value = af[list(af.keys())[0]]
+                for elem in array:
+                    if elem.get(af_key) == af_value:
+                        elem[rest] = uv
+# --- Aggregation pipeline ---
+# SQLiteCollection.aggregate() runs the pipeline shape reports use, $match, then $unwind, $group, $sort and
+# $limit in that order, as one SQL statement; $unwind becomes a json_each() join. Any other pipeline, or
+# a $match that is not fully expressible in SQL, runs through aggregate_documents() in Python instead.
+# As in SQLite, numeric strings count as numbers in $sum and $avg.
+GROUP_ACCUMULATORS = {'$sum': 'SUM', '$avg': 'AVG', '$min': 'MIN', '$max': 'MAX'}
+def field_reference(expr):
+    """Returns the dotted path of a '$field' expression, or None for a literal."""
+    if isinstance(expr, str) and expr.startswith('$') and len(expr) > 1:
+        return expr[1:]
+    return None
+def unwind_path(arg):
+    path = field_reference(arg['path'] if isinstance(arg, dict) else arg)
+    if path is None:
+        raise ValueError(f"Invalid $unwind: {arg!r}")
+    return path
+def expression_value(d, expr):
+    path = field_reference(expr)
+    if path is None:
+        return expr
+    return next(path_values(d, path.split('.')), None)
+def numeric(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return 0
+    return None
+def group_documents(documents, spec):
+    groups = {}
+    for d in documents:
+        key_expr = spec.get('_id')
+        if isinstance(key_expr, dict):
+            key = {k: expression_value(d, v) for k, v in key_expr.items()}
+        else:
+            key = expression_value(d, key_expr)
+        out = groups.setdefault(dumps_json(key), {'_id': key})
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, expr), = accumulator.items()
+            if op == '$count':
+                out[name] = out.get(name, 0) + 1
+                continue
+            value = numeric(expression_value(d, expr)) if op in ('$sum', '$avg') else expression_value(d, expr)
+            if op == '$sum':
+                out[name] = out.get(name, 0) + (value or 0)
+            elif op == '$avg':
+                if value is not None:
+                    total, count = out.get(name) or (0, 0)
+                    out[name] = (total + value, count + 1)
+                else:
+                    out.setdefault(name, None)
+            elif op in ('$min', '$max'):
+                current = out.get(name)
+                if value is not None and (current is None or (sql_sort_key(value) < sql_sort_key(current)) == (op == '$min')):
+                    out[name] = value
+                else:
+                    out.setdefault(name, None)
+            else:
+                raise ValueError(f"Unsupported accumulator {op}")
+    results = list(groups.values())
+    for out in results:
+        for name, accumulator in spec.items():
+            if name != '_id' and '$avg' in accumulator and out.get(name) is not None:
+                total, count = out[name]
+                out[name] = total / count
+    return results
+def aggregate_documents(documents, pipeline):
+    """Runs a pipeline over decoded documents in Python; the fallback for pipelines SQL cannot run."""
+    documents = list(documents)
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == '$match':
+            match = compile_matcher(arg)
+            documents = [d for d in documents if match(d)]
+        elif op == '$unwind':
+            parts = unwind_path(arg).split('.')
+            unwound = []
+            for d in documents:
+                value = next(path_values(d, parts), None)
+                for element in (value if isinstance(value, list) else [] if value is None else [value]):
+                    copy = copy_document(d)
+                    parent = parent_for_path(copy, parts, True)
+                    parent[container_key(parent, parts[-1])] = element
+                    unwound.append(copy)
+            documents = unwound
+        elif op == '$group':
+            documents = group_documents(documents, arg)
+        elif op == '$sort':
+            for field, direction in reversed(list(arg.items())):
+                documents.sort(key=lambda d, f=field: sql_sort_key(expression_value(d, '$' + f)), reverse=direction < 0)
+        elif op == '$limit':
+            documents = documents[:int(arg)]
+        else:
+            raise ValueError(f"Unsupported aggregation stage {op}")
+    return documents
+def merge_filters(first, second):
+    """Combines two filters into one that matches both, merging their fields; conflicting conditions go under $and."""
+    merged = dict(first)
+    for key, value in second.items():
+        if key not in merged:
+            merged[key] = value
+        elif (not key.startswith('$') and is_operator_dict(merged[key]) and is_operator_dict(value)
+              and not set(merged[key]) & set(value)):
+            merged[key] = {**merged[key], **value}
+        else:
+            return {'$and': [first, second]}
+    return merged
+def pipeline_plan(pipeline):
+    """Splits a pipeline into {stage: argument} when it has the SQL shape, else returns None."""
+    order = ['$match', '$unwind', '$group', '$sort', '$limit']
+    plan, position = {}, 0
+    for stage in pipeline:
+        if len(stage) != 1:
+            return None
+        (op, arg), = stage.items()
+        if op == '$match' and position == 0 and op in plan:
+            plan[op] = merge_filters(plan[op], arg)
+            continue
+        if op not in order or order.index(op) < position or op in plan:
+            return None
+        position = order.index(op)
+        plan[op] = arg
+    if '$unwind' in plan and '$group' not in plan:
+        return None
+    if '$group' in plan:
+        for name, accumulator in plan['$group'].items():
+            if name != '_id' and (not isinstance(accumulator, dict) or len(accumulator) != 1
+                                  or next(iter(accumulator)) not in ('$count', *GROUP_ACCUMULATORS)):
+                return None
+    return plan
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+# --- Secondary indexes on JSON fields ---
+# Expression indexes created by ensure_indexes() at startup. Add a field (or a tuple of fields for a
+# compound index) here and it is built on the next start; managed indexes removed from this registry are dropped.
+# Indexes added at runtime with SQLiteCollection.create_index() are recorded in the json_indexes table and
+# kept across restarts until drop_index() removes them.
+COLLECTION_INDEXES = {
+    'active_orders': ['orderId'],
+    'customers': ['phone_number'],
+    'employees': ['employeeId', 'email'],
+    'kitchen_saved_orders': ['orderId'],
+    'pos_opening_entries': ['name', ('user_id', 'date')],
+    'purchase_invoices': ['series', 'created_at'],
+    'purchase_orders': ['series'],
+    'purchase_receipts': ['series'],
+    'sales': ['invoice_no', 'created_at'],
+    'tables': [('table_number', 'floor')],
+    'trip_reports': [('deliveryPersonId', 'created_at')],
+    'users': ['email', 'phone_number', 'username'],
+}
+MANAGED_INDEX_PREFIX = 'ix_json_'
+def index_name(table, fields):
+    return MANAGED_INDEX_PREFIX + table + '__' + '__'.join(f.replace('.', '_') for f in fields)
+def create_json_index(conn, table, fields):
+    if isinstance(fields, str):
+        fields = (fields,)
+    name = index_name(table, fields)
+    columns = ', '.join(json_field_sql(f) for f in fields)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    return name
+def runtime_indexes(conn):
+    """Returns {table: [fields, ...]} for the indexes registered with create_index()."""
+    conn.execute("CREATE TABLE IF NOT EXISTS json_indexes (collection TEXT NOT NULL, fields TEXT NOT NULL, PRIMARY KEY (collection, fields))")
+    registry = {}
+    for table, fields in conn.execute("SELECT collection, fields FROM json_indexes"):
+        registry.setdefault(table, []).append(tuple(json.loads(fields)))
+    return registry
+def ensure_indexes(conn, registry=None):
+    """Creates the declared and runtime-registered JSON expression indexes and drops managed ones neither declares."""
+    registry = COLLECTION_INDEXES if registry is None else registry
+    wanted = set()
+    for source in (registry, runtime_indexes(conn)):
+        for table, field_specs in source.items():
+            for fields in field_specs:
+                wanted.add(create_json_index(conn, table, fields))
+    existing = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE ?", (MANAGED_INDEX_PREFIX + '%',)
+    ).fetchall()
+    for (name,) in existing:
+        if name not in wanted:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+            logger.info(f"Dropped undeclared index {name}")
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+    return sorted(wanted)
+def list_indexes(conn, table=None):
+    """Returns {table: {index_name: sql}} for the indexes that currently exist in the database."""
+    query = "SELECT tbl_name, name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+    params = ()
+    if table:
+        query += " AND tbl_name = ?"
+        params = (table,)
+    indexes = {}
+    for tbl_name, name, sql in conn.execute(query, params):
+        indexes.setdefault(tbl_name, {})[name] = sql
+    return indexes
+# --- Typed columns and line items ---
+# Hot collections also expose their top-level report fields as typed generated columns, and their line
+# items as rows of <table>_line_items kept in sync by triggers, so reports can run as plain indexed SQL.
+# Every write through SQLiteCollection (including in-place json_set updates and bulk writes) updates them.
+# Filters compare strings against the indexed TEXT columns directly (sales.date has no JSON index of its own),
+# and $unwind reports over the line item array read <table>_line_items when no archived month is involved.
+TYPED_COLLECTIONS = {
+    'sales': {
+        'columns': [('invoice_no', 'TEXT'), ('date', 'TEXT'), ('status', 'TEXT'), ('grand_total', 'REAL'),
+                    ('total', 'REAL'), ('vat_amount', 'REAL'), ('userId', 'TEXT')],
+        'indexed': ['date', 'status'],
+        'line_items': 'items',
+    },
+    'active_orders': {
+        'columns': [('orderNo', 'TEXT'), ('orderType', 'TEXT'), ('status', 'TEXT'), ('userId', 'TEXT')],
+        'indexed': [],
+        'line_items': 'cartItems',
+    },
+    'trip_reports': {
+        'columns': [('orderNo', 'TEXT'), ('status', 'TEXT'), ('deliveryPersonId', 'TEXT'), ('created_at', 'TEXT')],
+        'indexed': [],
+        'line_items': 'cartItems',
+    },
+}
+# (column, type, SQL expression over a json_each() element named `value`)
+LINE_ITEM_COLUMNS = [
+    ('item_name', 'TEXT', "json_extract(value, '$.item_name')"),
+    ('quantity', 'NUMERIC', "json_extract(value, '$.quantity')"),
+    ('basePrice', 'REAL', "json_extract(value, '$.basePrice')"),
+    ('amount', 'REAL', "COALESCE(json_extract(value, '$.amount'), json_extract(value, '$.totalPrice'))"),
+    ('kitchen', 'TEXT', "json_extract(value, '$.kitchen')"),
+]
+# Line item columns holding a field's value as stored, so reports can read them instead of json_each().
+LINE_ITEM_FIELDS = {column for column, _, expr in LINE_ITEM_COLUMNS if expr == f"json_extract(value, '$.{column}')"}
+SQLITE_HAS_GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 31, 0)
+def line_items_table(table):
+    return f"{table}_line_items"
+def filter_columns(table):
+    """Returns {field: column} for the indexed TEXT generated columns that filters on table can compare directly."""
+    spec = TYPED_COLLECTIONS.get(table)
+    if spec is None or not SQLITE_HAS_GENERATED_COLUMNS:
+        return {}
+    types = dict(spec['columns'])
+    return {column: column for column in spec['indexed'] if types[column] == 'TEXT'}
+def line_items_insert_sql(table, array_field, row='new', document=None):
+    """INSERT ... SELECT filling line item rows from `new` inside a trigger, or from every row when row is the table."""
+    document = document or f"{row}.data"
+    columns = ', '.join(column for column, _, _ in LINE_ITEM_COLUMNS)
+    values = ', '.join(expr for _, _, expr in LINE_ITEM_COLUMNS)
+    path = sql_literal(json_path(array_field))
+    return (
+        f"INSERT INTO {line_items_table(table)} (parent_id, position, {columns}) "
+        f"SELECT {row}.id, key, {values} FROM {table + ', ' if row == table else ''}json_each({document}, {path}) "
+        f"WHERE json_type({document}, {path}) = 'array' AND type = 'object'"
+    )
+def ensure_typed_schema(conn, registry=None):
+    """Adds the declared generated columns, line item tables and sync triggers, backfilling new line item tables."""
+    registry = TYPED_COLLECTIONS if registry is None else registry
+    for table, spec in registry.items():
+        if SQLITE_HAS_GENERATED_COLUMNS:
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+            for column, column_type in spec['columns']:
+                if column not in existing:
+                    conn.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} {column_type} "
+                        f"GENERATED ALWAYS AS ({json_field_sql(column)}) VIRTUAL"
+                    )
+            for column in spec['indexed']:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS ix_col_{table}__{column} ON {table} ({column})")
+        lines = line_items_table(table)
+        declared = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({lines})")}
+        if declared and any(declared.get(column) != column_type for column, column_type, _ in LINE_ITEM_COLUMNS):
+            conn.execute(f"DROP TABLE {lines}")
+            declared = {}
+        is_new = not declared
+        columns = ', '.join(f"{column} {column_type}" for column, column_type, _ in LINE_ITEM_COLUMNS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {lines} (parent_id TEXT NOT NULL, position INTEGER NOT NULL, {columns}, PRIMARY KEY (parent_id, position))")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS ix_col_{lines}__item_name ON {lines} (item_name)")
+        array_field = spec['line_items']
+        # Compressing a row only swaps `data` for a stub, so it must leave the line items alone.
+        when = "WHEN new.packed IS NULL " if 'packed' in table_columns(conn, table) else ''
+        ensure_trigger(conn, f"{lines}_insert", f"CREATE TRIGGER {lines}_insert AFTER INSERT ON {table} BEGIN {line_items_insert_sql(table, array_field)}; END")
+        ensure_trigger(
+            conn, f"{lines}_update",
+            f"CREATE TRIGGER {lines}_update AFTER UPDATE OF id, data ON {table} {when}BEGIN "
+            f"DELETE FROM {lines} WHERE parent_id = old.id; {line_items_insert_sql(table, array_field)}; END"
+        )
+        ensure_trigger(conn, f"{lines}_delete", f"CREATE TRIGGER {lines}_delete AFTER DELETE ON {table} BEGIN DELETE FROM {lines} WHERE parent_id = old.id; END")
+        if is_new:
+            rebuild_line_items(conn, table, registry)
+    conn.commit()
+def ensure_trigger(conn, name, sql):
+    """Creates trigger `name` from sql, replacing an existing trigger whose definition differs; True if it did."""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()
+    if row and row[0] == sql:
+        return False
+    if row:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute(sql)
+    return True
+def rebuild_line_items(conn, table, registry=None):
+    """Repopulates <table>_line_items from the stored documents."""
+    registry = TYPED_COLLECTIONS if registry is None else registry
+    conn.execute(f"DELETE FROM {line_items_table(table)}")
+    document = cold_source(table) if table in COMPRESSIBLE_COLLECTIONS else None
+    conn.execute(line_items_insert_sql(table, registry[table]['line_items'], row=table, document=document))
+    conn.commit()
+# --- Cold document compression ---
+# Documents of these collections older than "compress_after_days" (config.json) are compressed by
+# compress_cold_documents(). A cold row keeps a stub in `data` (top-level scalars, containers emptied) so
+# indexes, typed columns and top-level filters behave as before, and the full document in `packed`.
+# Reads inflate it transparently; any write stores the full document again and clears `packed`.
+# The daily pass ends with a VACUUM when it compressed anything, so the file itself gets smaller.
+COMPRESSIBLE_COLLECTIONS = {'sales': 'created_at', 'trip_reports': 'created_at', 'picked_up_items': 'pickupTime'}
+COMPRESSION_DICT_SIZE = 32 * 1024
+COMPRESSION_SAMPLE_SIZE = 500
+COMPRESSION_DICTS = {}
+def cold_source(table=None):
+    """SQL expression yielding the full document of a row that may be compressed."""
+    prefix = f"{table}." if table else ''
+    return f"CASE WHEN {prefix}packed IS NULL THEN {prefix}data ELSE inflate({prefix}packed) END"
+def document_stub(doc):
+    return {k: type(v)() if isinstance(v, (dict, list)) else v for k, v in doc.items()}
+def deflate_document(text, dict_id):
+    """Compresses JSON text with a shared dictionary: codec byte, 4-byte dictionary id, payload."""
+    codec, dictionary = COMPRESSION_DICTS[dict_id]
+    raw = text.encode('utf-8')
+    if codec == 'zstd':
+        payload = zstandard.ZstdCompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)).compress(raw)
+    else:
+        compressor = zlib.compressobj(9, zdict=dictionary)
+        payload = compressor.compress(raw) + compressor.flush()
+    return (b'd' if codec == 'zstd' else b'z') + dict_id.to_bytes(4, 'big') + payload
+def inflate_document(packed):
+    """Returns the JSON text of a value produced by deflate_document(); registered in SQLite as inflate()."""
+    if packed is None:
+        return None
+    dictionary = COMPRESSION_DICTS[int.from_bytes(packed[1:5], 'big')][1]
+    if packed[:1] == b'd':
+        raw = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)).decompress(packed[5:])
+    else:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        raw = decompressor.decompress(packed[5:]) + decompressor.flush()
+    return raw.decode('utf-8')
+def table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+def ensure_compression_schema(conn):
+    """Adds the `packed` column to compressible collections and loads the shared compression dictionaries."""
+    conn.execute("CREATE TABLE IF NOT EXISTS compression_dicts (id INTEGER PRIMARY KEY, collection TEXT, codec TEXT, dict BLOB)")
+    for table in COMPRESSIBLE_COLLECTIONS:
+        if 'packed' not in table_columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN packed BLOB")
+    for dict_id, codec, dictionary in conn.execute("SELECT id, codec, dict FROM compression_dicts"):
+        COMPRESSION_DICTS[dict_id] = (codec, dictionary)
+    conn.commit()
+def compression_dict(conn, table, codec, samples):
+    """Returns the id of the table's dictionary for codec, training one from sample documents the first time."""
+    row = conn.execute(
+        "SELECT id FROM compression_dicts WHERE collection = ? AND codec = ? ORDER BY id DESC LIMIT 1", (table, codec)
+    ).fetchone()
+    if row:
+        return row[0]
+    if codec == 'zstd':
+        dictionary = zstandard.train_dictionary(COMPRESSION_DICT_SIZE, [text.encode('utf-8') for text in samples]).as_bytes()
+    else:
+        # zlib only looks back 32 KB, so the end of the concatenated samples is what it uses.
+        dictionary = ''.join(samples).encode('utf-8')[-COMPRESSION_DICT_SIZE:]
+    cur = conn.execute("INSERT INTO compression_dicts (collection, codec, dict) VALUES (?, ?, ?)", (table, codec, dictionary))
+    COMPRESSION_DICTS[cur.lastrowid] = (codec, dictionary)
+    return cur.lastrowid
+def compress_cold_documents(conn, table, older_than_days, codec='zlib'):
+    """Compresses documents of table whose age field is older than older_than_days; returns how many."""
+    if codec == 'zstd' and zstandard is None:
+        logger.warning("zstandard library not found. Compressing cold documents with zlib instead.")
+        codec = 'zlib'
+    cutoff = (datetime.now(ZoneInfo("UTC")) - timedelta(days=older_than_days)).isoformat()
+    ids = [row[0] for row in conn.execute(
+        f"SELECT id FROM {table} WHERE packed IS NULL AND {json_field_sql(COMPRESSIBLE_COLLECTIONS[table])} < ?", (cutoff,)
+    )]
+    dict_id = None
+    for start in range(0, len(ids), BULK_ID_CHUNK):
+        chunk = ids[start:start + BULK_ID_CHUNK]
+        rows = conn.execute(
+            f"SELECT id, {doc_text()} FROM {table} WHERE id IN ({', '.join(['?'] * len(chunk))})", chunk
+        ).fetchall()
+        with conn.transaction():
+            if dict_id is None:
+                try:
+                    dict_id = compression_dict(conn, table, codec, [text for _, text in rows[:COMPRESSION_SAMPLE_SIZE]])
+                except Exception as e:
+                    logger.warning(f"Could not train a {codec} dictionary for {table} ({e}); using zlib")
+                    codec = 'zlib'
+                    dict_id = compression_dict(conn, table, codec, [text for _, text in rows[:COMPRESSION_SAMPLE_SIZE]])
+            conn.executemany(
+                f"UPDATE {table} SET data = {doc_param()}, packed = ? WHERE id = ?",
+                [(dumps_json(document_stub(loads_json(text))), deflate_document(text, dict_id), row_id) for row_id, text in rows]
+            )
+    if ids:
+        logger.info(f"Compressed {len(ids)} cold {table} documents")
+    return len(ids)
+def vacuum_database(pool):
+    """Rewrites the database file with VACUUM so the space compression freed leaves it; returns the pages saved.
+
+    Shrunken rows leave their pages mostly empty rather than free, so only a rewrite reclaims them.
+    VACUUM cannot run inside a transaction, so it is skipped while one is open on this thread."""
+    if pool.in_transaction():
+        logger.warning("Not vacuuming the database inside a transaction")
+        return 0
+    connection = pool.connection()
+    if connection.in_transaction:
+        connection.commit()
+    pages = connection.execute("PRAGMA page_count").fetchone()[0]
+    connection.execute("VACUUM")
+    # In WAL mode the rewritten pages land in the WAL; a truncating checkpoint moves them back and shrinks the file.
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    saved = pages - connection.execute("PRAGMA page_count").fetchone()[0]
+    logger.info(f"Vacuumed the database, reclaiming {saved} pages")
+    return saved
+def compress_cold_collections():
+    days = config.get('compress_after_days')
+    if conn is None or not days:
+        return
+    try:
+        compressed = 0
+        for table in COMPRESSIBLE_COLLECTIONS:
+            compressed += compress_cold_documents(conn, table, int(days), config.get('compression_codec', 'zlib'))
+        if compressed:
+            vacuum_database(conn)
+    except Exception as e:
+        logger.error(f"Error compressing cold documents: {str(e)}")
+# --- Monthly archive partitions ---
+# Documents of these collections whose date field is older than "archive_after_days" (config.json) are
+# moved by archive_documents() into one SQLite file per month under archive/, which keeps the live
+# tables, their indexes and line items small. A read whose filter has a range on the date field that
+# reaches archived months ATTACHes those files on demand and runs over the live table UNION ALL the
+# archived ones; reads without such a range only see the live table. Snapshots copy the archive files
+# along with the main one (ARCHIVE_LOCK keeps the archiver from moving rows meanwhile), and export
+# collections read every archived month.
+ARCHIVED_COLLECTIONS = {'sales': 'date', 'trip_reports': 'created_at', 'pos_closing_entries': 'creation', 'picked_up_items': 'pickupTime'}
+ARCHIVE_DIR = os.path.join(CONFIG_DIR, 'archive')
+# SQLite allows 10 attached databases by default; spans over more months are read a group at a time.
+ARCHIVE_MAX_ATTACHED = 8
+ARCHIVE_MONTHS = {}
+ARCHIVE_MONTH_RE = re.compile(r'^\d{4}-\d{2}$')
+ARCHIVE_LOCK = threading.Lock()
+def archive_schema(month):
+    return f"archive_{month.replace('-', '_')}"
+def archive_path(month, directory=None):
+    return os.path.join(directory or ARCHIVE_DIR, f"{month}.db")
+def archive_columns(table):
+    return 'id, data, packed' if table in COMPRESSIBLE_COLLECTIONS else 'id, data'
+def ensure_archive_schema(conn):
+    """Creates the archive catalog and loads which months each collection has archived."""
+    conn.execute("CREATE TABLE IF NOT EXISTS archive_catalog (collection TEXT NOT NULL, month TEXT NOT NULL, documents INTEGER NOT NULL, PRIMARY KEY (collection, month))")
+    conn.commit()
+    ARCHIVE_MONTHS.clear()
+    ARCHIVE_MONTHS.update(load_archive_catalog(conn))
+def load_archive_catalog(conn):
+    """Returns {collection: [month, ...]} from the database's archive catalog, oldest month first."""
+    catalog = {}
+    for table, month in conn.execute("SELECT collection, month FROM archive_catalog ORDER BY month"):
+        catalog.setdefault(table, []).append(month)
+    return catalog
+def date_conditions(filter_, field):
+    """Yields the conditions filter_ places on field at the top level and inside $and."""
+    if field in filter_:
+        yield filter_[field]
+    for subfilter in filter_.get('$and', ()):
+        if isinstance(subfilter, dict):
+            yield from date_conditions(subfilter, field)
+def archive_span(table, filter_, catalog=None, include_all=False):
+    """Returns the archived months of table that filter_'s conditions on the collection's date field reach.
+
+    catalog defaults to ARCHIVE_MONTHS; with include_all, a filter that sets no date bound reaches every month."""
+    field = ARCHIVED_COLLECTIONS.get(table)
+    months = (ARCHIVE_MONTHS if catalog is None else catalog).get(table)
+    if not months:
+        return []
+    if not isinstance(filter_, dict):
+        return months if include_all else []
+    bounded = False
+    for condition in date_conditions(filter_, field):
+        reached = condition_months(months, condition)
+        if reached is not None:
+            months, bounded = reached, True
+    return months if bounded or include_all else []
+def condition_months(months, condition):
+    """Returns the months that one condition on the date field can match, or None when it sets no bound."""
+    condition = filter_operand(condition)
+    if not is_operator_dict(condition):
+        return [m for m in months if isinstance(condition, str) and condition[:7] == m]
+    low = high = None
+    for op, operand in condition.items():
+        if op == '$in' and isinstance(operand, list):
+            wanted = {str(v)[:7] for v in operand if isinstance(v, str)}
+            return [m for m in months if m in wanted]
+        if not isinstance(operand, str):
+            continue
+        if op in ('$gt', '$gte'):
+            low = max(low, operand[:7]) if low else operand[:7]
+        elif op in ('$lt', '$lte'):
+            high = min(high, operand[:7]) if high else operand[:7]
+    if low is None and high is None:
+        return None
+    return [m for m in months if (low is None or m >= low) and (high is None or m <= high)]
+def sql_sort_key(value):
+    """Orders decoded JSON values the way SQLite orders json_extract() results: NULL, numbers, text, JSON."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, dumps_json(value))
+def extract_value(doc, parts):
+    """Returns what json_extract() reads at the dotted path parts: arrays are only entered by index."""
+    for part in parts:
+        if isinstance(doc, dict):
+            doc = doc.get(part)
+        elif isinstance(doc, list) and part.isdigit() and int(part) < len(doc):
+            doc = doc[int(part)]
+        else:
+            return None
+    return doc
+class SortKey:
+    """Orders an (id, document) row by [(field, direction), ...] the way sort_sql() does, for heapq.merge()."""
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, row, sort):
+        self.values = [sql_sort_key(row[0] if field == '_id' else extract_value(row[1], field.split('.'))) for field, _ in sort]
+        self.directions = [direction for _, direction in sort]
+
+    def __lt__(self, other):
+        for mine, theirs, direction in zip(self.values, other.values, self.directions):
+            if mine != theirs:
+                return mine < theirs if direction > 0 else theirs < mine
+        return False
+def archive_documents(conn, table, older_than_days):
+    """Moves documents of table whose date field is older than older_than_days into the monthly archives."""
+    field = json_field_sql(ARCHIVED_COLLECTIONS[table])
+    cutoff = (datetime.now(ZoneInfo("UTC")) - timedelta(days=older_than_days)).strftime('%Y-%m-%d')
+    by_month = {}
+    for row_id, month in conn.execute(f"SELECT id, substr({field}, 1, 7) FROM {table} WHERE {field} < ?", (cutoff,)):
+        if isinstance(month, str) and ARCHIVE_MONTH_RE.match(month):
+            by_month.setdefault(month, []).append(row_id)
+    columns = archive_columns(table)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    moved = 0
+    # Held while rows are in flight between files, so a snapshot never sees them in both or neither.
+    with ARCHIVE_LOCK:
+        for month, ids in sorted(by_month.items()):
+            schema = archive_schema(month)
+            if not conn.attach(archive_path(month), schema):
+                raise RuntimeError(f"Could not attach the {month} archive")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} (id TEXT PRIMARY KEY, data TEXT{', packed BLOB' if 'packed' in columns else ''})")
+            for start in range(0, len(ids), BULK_ID_CHUNK):
+                chunk = ids[start:start + BULK_ID_CHUNK]
+                marks = ', '.join(['?'] * len(chunk))
+                # In WAL mode a commit is atomic per file, not across them; INSERT OR REPLACE lets an
+                # interrupted run be repeated without duplicating what already reached the archive.
+                with conn.transaction(archives=False):
+                    conn.execute(f"INSERT OR REPLACE INTO {schema}.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE id IN ({marks})", chunk)
+                    # The marker row keeps the change log from recording the move as a delete; it never commits.
+                    conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('archiving', ?)", (table,))
+                    conn.execute(f"DELETE FROM main.{table} WHERE id IN ({marks})", chunk)
+                    conn.execute("DELETE FROM storage_meta WHERE key = 'archiving'")
+                    conn.execute(
+                        "INSERT INTO archive_catalog (collection, month, documents) VALUES (?, ?, ?) "
+                        "ON CONFLICT (collection, month) DO UPDATE SET documents = documents + excluded.documents",
+                        (table, month, len(chunk))
+                    )
+            if month not in ARCHIVE_MONTHS.setdefault(table, []):
+                ARCHIVE_MONTHS[table] = sorted(ARCHIVE_MONTHS[table] + [month])
+            moved += len(ids)
+    if moved:
+        logger.info(f"Archived {moved} {table} documents into {len(by_month)} monthly partitions")
+    return moved
+def archive_old_collections():
+    days = config.get('archive_after_days')
+    if conn is None or not days:
+        return
+    try:
+        for table in ARCHIVED_COLLECTIONS:
+            archive_documents(conn, table, int(days))
+    except Exception as e:
+        logger.error(f"Error archiving old documents: {str(e)}")
+# --- Change log ---
+# Triggers append one row per insert, update and delete of every collection to change_log inside the
+# writing transaction, so a client that remembers the last seq it saw can ask for what changed since.
+# seq is AUTOINCREMENT and never reused. compact_change_log() keeps only the newest entry per document
+# and drops entries older than "change_log_retention_days"; the highest seq dropped that way is kept as
+# the floor, and a client asking for changes since an older seq is told to resync from scratch.
+CHANGE_LOG_RETENTION_DAYS = 7
+CHANGE_LOG_PAGE = 1000
+def ensure_change_log(conn, tables):
+    """Creates the change_log table and the triggers feeding it from every collection."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS change_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, "
+        "doc_id TEXT NOT NULL, op TEXT NOT NULL, ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS change_log_doc ON change_log (collection, doc_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS change_log_ts ON change_log (ts)")
+    for table in tables:
+        entry = "INSERT INTO change_log (collection, doc_id, op) VALUES ('{table}', {row}.id, '{op}')"
+        # Compressing a cold row rewrites it without changing the document, so it is not logged.
+        when = "WHEN new.packed IS NULL " if table in COMPRESSIBLE_COLLECTIONS else ''
+        # Moving a row into its monthly archive keeps the document, so neither is that.
+        archiving = "WHEN NOT EXISTS (SELECT 1 FROM storage_meta WHERE key = 'archiving') " if table in ARCHIVED_COLLECTIONS else ''
+        ensure_trigger(conn, f"{table}_log_insert", f"CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} BEGIN {entry.format(table=table, row='new', op='insert')}; END")
+        ensure_trigger(conn, f"{table}_log_update", f"CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} {when}BEGIN {entry.format(table=table, row='new', op='update')}; END")
+        ensure_trigger(conn, f"{table}_log_delete", f"CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} {archiving}BEGIN {entry.format(table=table, row='old', op='delete')}; END")
+    conn.commit()
+def change_log_floor(conn):
+    row = conn.execute("SELECT value FROM storage_meta WHERE key = 'change_log_floor'").fetchone()
+    return int(row[0]) if row else 0
+def changes_since(conn, seq, collections=None, limit=CHANGE_LOG_PAGE):
+    """Returns the change log entries after seq, oldest first, as a ChangesResult.
+
+    resync is True when entries after seq were already dropped by retention, in which case the
+    caller has to reload the collections in full before following the log from last_seq."""
+    sql = "SELECT seq, collection, doc_id, op, ts FROM change_log WHERE seq > ?"
+    params = [int(seq)]
+    if collections:
+        sql += f" AND collection IN ({', '.join(['?'] * len(collections))})"
+        params.extend(collections)
+    rows = conn.execute(sql + " ORDER BY seq LIMIT ?", params + [int(limit)]).fetchall()
+    changes = [{'seq': s, 'collection': c, '_id': i, 'op': op, 'ts': ts} for s, c, i, op, ts in rows]
+    if changes:
+        last_seq = changes[-1]['seq']
+    else:
+        last_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        last_seq = max(int(seq), last_seq[0] if last_seq else 0)
+    return type('ChangesResult', (), {
+        'changes': changes,
+        'last_seq': last_seq,
+        'has_more': len(changes) == int(limit),
+        'resync': int(seq) < change_log_floor(conn),
+    })()
+def compact_change_log(conn, retention_days=CHANGE_LOG_RETENTION_DAYS):
+    """Drops superseded entries and those older than retention_days; returns how many were removed."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%dT%H:%M:%fZ')
+    with conn.transaction():
+        expired = conn.execute("SELECT MAX(seq) FROM change_log WHERE ts < ?", (cutoff,)).fetchone()[0]
+        removed = conn.execute("DELETE FROM change_log WHERE ts < ?", (cutoff,)).rowcount
+        if expired is not None:
+            conn.execute(
+                "INSERT INTO storage_meta (key, value) VALUES ('change_log_floor', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), excluded.value)",
+                (expired,)
+            )
+        removed += conn.execute(
+            "DELETE FROM change_log WHERE seq NOT IN (SELECT MAX(seq) FROM change_log GROUP BY collection, doc_id)"
+        ).rowcount
+    if removed:
+        logger.info(f"Compacted the change log, removed {removed} entries")
+    return removed
+def compact_change_log_job():
+    if conn is None:
+        return
+    try:
+        compact_change_log(conn, int(config.get('change_log_retention_days', CHANGE_LOG_RETENTION_DAYS)))
+    except Exception as e:
+        logger.error(f"Error compacting the change log: {str(e)}")
+# --- Menu search ---
+# An FTS5 index over the names, codes and groups of menu items, their addons and combos, variants and
+# combo offers. Triggers keep it in step with the source collections, so every write path is covered.
+# Each source is (kind, array, name, code, group): with an array, one entry per element, whose name and
+# code are read from the element; the group is always read from the document.
+MENU_SEARCH_SOURCES = {
+    'items': [
+        ('item', None, '$.item_name', '$.item_code', '$.item_group'),
+        ('addon', '$.addons', '$.name1', None, '$.item_group'),
+        ('combo', '$.combos', '$.name1', None, '$.item_group'),
+    ],
+    'variants': [
+        ('variant', None, '$.heading', None, None),
+        ('variant_option', '$.subheadings', '$.name', None, '$.heading'),
+    ],
+    'combo_offers': [('combo_offer', None, '$.description', None, None)],
+}
+# bm25() weights for the indexed columns: name, code, item_group.
+MENU_SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+MENU_SEARCH_LIMIT = 20
+MENU_SEARCH_AVAILABLE = False
+def menu_search_insert_sql(table, row='new'):
+    """INSERT ... SELECT statements indexing the documents of `row` (new in a trigger, the table to backfill)."""
+    statements = []
+    for kind, array, name, code, group in MENU_SEARCH_SOURCES[table]:
+        document = f"{row}.data"
+        element = 'e.value' if array else document
+        sources = [] if row in ('new', 'old') else [row]
+        if array:
+            sources.append(f"json_each({document}, '{array}') AS e")
+        sql = (
+            "INSERT INTO menu_search (name, code, item_group, kind, source, doc_id, position) "
+            f"SELECT json_extract({element}, '{name}'), {f'json_extract({element}, {sql_literal(code)})' if code else 'NULL'}, "
+            f"{f'json_extract({document}, {sql_literal(group)})' if group else 'NULL'}, '{kind}', '{table}', {row}.id, "
+            f"{'e.key' if array else 'NULL'}"
+        )
+        if sources:
+            sql += " FROM " + ', '.join(sources)
+        statements.append(sql + f" WHERE json_extract({element}, '{name}') IS NOT NULL")
+    return statements
+def ensure_menu_search(conn):
+    """Creates the menu_search FTS5 index and its triggers, rebuilding the index when either is new."""
+    global MENU_SEARCH_AVAILABLE
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'menu_search'").fetchone()
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS menu_search USING fts5(name, code, item_group, kind UNINDEXED, "
+            "source UNINDEXED, doc_id UNINDEXED, position UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite was built without FTS5 ({e}). Menu search is disabled.")
+        return False
+    changed = not exists
+    for table, sources in MENU_SEARCH_SOURCES.items():
+        watched = {path for _, array, name, code, group in sources for path in ((array,) if array else (name, code)) + (group,) if path}
+        when = ' OR '.join(f"json_extract(old.data, '{path}') IS NOT json_extract(new.data, '{path}')" for path in sorted(watched))
+        remove = f"DELETE FROM menu_search WHERE source = '{table}' AND doc_id = old.id"
+        inserts = '; '.join(menu_search_insert_sql(table))
+        changed |= ensure_trigger(conn, f"{table}_search_insert", f"CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table} BEGIN {inserts}; END")
+        changed |= ensure_trigger(conn, f"{table}_search_update", f"CREATE TRIGGER {table}_search_update AFTER UPDATE ON {table} WHEN old.id IS NOT new.id OR {when} BEGIN {remove}; {inserts}; END")
+        changed |= ensure_trigger(conn, f"{table}_search_delete", f"CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table} BEGIN {remove}; END")
+    if changed:
+        conn.execute("DELETE FROM menu_search")
+        for table in MENU_SEARCH_SOURCES:
+            for sql in menu_search_insert_sql(table, row=table):
+                conn.execute(sql)
+        conn.execute("INSERT INTO menu_search (menu_search) VALUES ('optimize')")
+    conn.commit()
+    MENU_SEARCH_AVAILABLE = True
+    return True
+def menu_search_query(text):
+    """Turns free text into an FTS5 query matching every word as a prefix, or None when it has no words."""
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{word}"*' for word in words) or None
+def search_menu(conn, text, kinds=None, limit=MENU_SEARCH_LIMIT):
+    """Returns the best matching menu entries for text, most relevant first."""
+    query = menu_search_query(text)
+    if query is None:
+        return []
+    sql = "SELECT kind, doc_id, position, name, code, item_group FROM menu_search WHERE menu_search MATCH ?"
+    params = [query]
+    if kinds:
+        sql += f" AND kind IN ({', '.join(['?'] * len(kinds))})"
+        params.extend(kinds)
+    sql += f" ORDER BY bm25(menu_search, {', '.join(map(str, MENU_SEARCH_WEIGHTS))}) LIMIT ?"
+    rows = conn.execute(sql, params + [int(limit)]).fetchall()
+    return [
+        {'type': kind, '_id': doc_id, 'index': position, 'name': name, 'item_code': code, 'item_group': group}
+        for kind, doc_id, position, name, code, group in rows
+    ]
+# --- Bulk writes ---
+BULK_ID_CHUNK = 500
+class InsertOne:
+    def __init__(self, document):
+        self.document = document
+class ReplaceOne:
+    def __init__(self, filter, replacement, upsert=False):
+        self.filter, self.replacement, self.upsert = filter, replacement, upsert
+class UpdateOne:
+    def __init__(self, filter, update, array_filters=None):
+        self.filter, self.update, self.array_filters = filter, update, array_filters
+class UpdateMany:
+    def __init__(self, filter, update):
+        self.filter, self.update = filter, update
+class DeleteOne:
+    def __init__(self, filter):
+        self.filter = filter
+class DeleteMany:
+    def __init__(self, filter):
+        self.filter = filter
+def key_filter(filter_):
+    """Returns (field, value) for a single top-level equality filter on a string or number, else None."""
+    if not isinstance(filter_, dict) or len(filter_) != 1:
+        return None
+    field, value = next(iter(filter_.items()))
+    if field.startswith('$') or '.' in field or isinstance(value, bool):
+        return None
+    if field == '_id':
+        return (field, value) if isinstance(value, str) else None
+    return (field, value) if isinstance(value, (str, int, float)) else None
+def key_value(doc, field):
+    value = doc.get(field)
+    return int(value) if isinstance(value, bool) else value
+class BulkWriter:
+    """Buffers row writes for SQLiteCollection.bulk_write and flushes runs of the same statement with executemany.
+
+    Operations filtering on a single field are resolved against an in-memory map of field value to ids,
+    loaded with one scan per field and kept current as the batch inserts, replaces and deletes rows."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.sql, self.params = None, []
+        self.key_maps = {}
+
+    def write(self, sql, params):
+        if sql != self.sql:
+            self.flush()
+            self.sql = sql
+        self.params.append(params)
+
+    def flush(self):
+        if self.params:
+            self.collection.conn.executemany(self.sql, self.params)
+        self.sql, self.params = None, []
+
+    def invalidate(self):
+        self.flush()
+        self.key_maps.clear()
+
+    def key_map(self, field):
+        if field not in self.key_maps:
+            self.flush()
+            by_value, by_id = {}, {}
+            if field == '_id':
+                rows = ((row_id, row_id, 'text') for (row_id,) in self.collection.conn.execute(f"SELECT id FROM {self.collection.name}"))
+            else:
+                path = sql_literal(json_path(field))
+                rows = self.collection.conn.execute(
+                    f"SELECT id, json_extract(data, {path}), json_type(data, {path}) FROM {self.collection.name}"
+                )
+            for row_id, value, value_type in rows:
+                if value_type in ('array', 'object'):
+                    by_value = None
+                    break
+                by_id[row_id] = value
+                if value is not None:
+                    by_value.setdefault(value, []).append(row_id)
+            self.key_maps[field] = (by_value, by_id) if by_value is not None else None
+        return self.key_maps[field]
+
+    def track(self, row_id, doc):
+        for field, key_map in list(self.key_maps.items()):
+            if key_map is None:
+                continue
+            by_value, by_id = key_map
+            old_value = by_id.pop(row_id, None)
+            if old_value is not None and row_id in by_value.get(old_value, []):
+                by_value[old_value].remove(row_id)
+            if doc is None:
+                continue
+            value = row_id if field == '_id' else key_value(doc, field)
+            if isinstance(value, (list, dict)):
+                self.key_maps[field] = None
+                continue
+            by_id[row_id] = value
+            if value is not None:
+                by_value.setdefault(value, []).append(row_id)
+
+    def find_ids(self, filter_, many):
+        key = key_filter(filter_)
+        key_map = self.key_map(key[0]) if key else None
+        if key_map is not None:
+            ids = key_map[0].get(key[1], [])
+            return list(ids) if many else ids[:1]
+        self.flush()
+        if not many:
+            row_id = self.collection._first_id(filter_)
+            return [] if row_id is None else [row_id]
+        return [row_id for row_id, _ in self.collection._select_live(filter_)]
+
+    def insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = str(uuid.uuid4())
+        self.write(f"INSERT INTO {self.collection.name} (id, data) VALUES (?, {doc_param()})", (doc['_id'], dumps_json(doc)))
+        self.track(doc['_id'], doc)
+        return doc['_id']
+
+    def replace(self, row_id, doc):
+        self.write(f"UPDATE {self.collection.name} SET {self.collection._set_data(doc_param())} WHERE id = ?", (dumps_json(doc), row_id))
+        self.track(row_id, doc)
+
+    def delete(self, row_id):
+        self.write(f"DELETE FROM {self.collection.name} WHERE id = ?", (row_id,))
+        self.track(row_id, None)
+
+    def execute(self, operation):
+        if isinstance(operation, InsertOne):
+            return type('InsertResult', (), {'inserted_id': self.insert(operation.document)})()
+        if isinstance(operation, ReplaceOne):
+            ids = self.find_ids(operation.filter, many=False)
+            if ids:
+                self.replace(ids[0], operation.replacement)
+                return type('UpdateResult', (), {'matched_count': 1, 'modified_count': 1, 'upserted_id': None})()
+            if operation.upsert:
+                upserted_id = self.insert(operation.replacement)
+                return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 1, 'upserted_id': upserted_id})()
+            return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 0, 'upserted_id': None})()
+        if isinstance(operation, (UpdateOne, UpdateMany)):
+            self.invalidate()
+            if isinstance(operation, UpdateOne):
+                result = self.collection.update_one(operation.filter, operation.update, operation.array_filters)
+            else:
+                result = self.collection.update_many(operation.filter, operation.update)
+            result.upserted_id = None
+            return result
+        if isinstance(operation, (DeleteOne, DeleteMany)):
+            ids = self.find_ids(operation.filter, many=isinstance(operation, DeleteMany))
+            for row_id in ids:
+                self.delete(row_id)
+            return type('DeleteResult', (), {'deleted_count': len(ids)})()
+        raise ValueError(f"Unsupported bulk operation: {type(operation).__name__}")
+# --- Document cache ---
+DOCUMENT_CACHE_MAX_BYTES = int(config.get('document_cache_mb', 8)) * 1024 * 1024
+CACHED_COLLECTIONS = ('items', 'variants', 'kitchens', 'item_groups', 'vat', 'system_settings', 'print_settings')
+DOCUMENT_CACHES = {}
+def copy_document(value):
+    """Copies a decoded JSON document; cheaper than copy.deepcopy since only dicts and lists are mutable."""
+    if isinstance(value, dict):
+        return {k: copy_document(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_document(v) for v in value]
+    return value
+def cache_key(filter_, limit, projection, sort, skip):
+    return json.dumps([filter_, limit, projection, sort, skip], sort_keys=True, default=str)
+class DocumentCache:
+    """LRU cache of decoded query results for one collection, capped at max_bytes of document JSON.
+
+    Every write through SQLiteCollection clears it after commit; a read that raced a write is not stored,
+    since the generation it started under is gone by then. Callers get copies they are free to mutate."""
+    def __init__(self, max_bytes=DOCUMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            rows = entry[0]
+        return [(row_id, copy_document(d)) for row_id, d in rows]
+
+    def put(self, key, rows, generation):
+        size = len(key) + len(dumps_json(rows))
+        if size > self.max_bytes:
+            return
+        rows = [(row_id, copy_document(d)) for row_id, d in rows]
+        with self.lock:
+            if generation != self.generation:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (rows, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
+
+    def info(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+def enable_document_cache(names=CACHED_COLLECTIONS, max_bytes=DOCUMENT_CACHE_MAX_BYTES):
+    for name in names:
+        DOCUMENT_CACHES.setdefault(name, DocumentCache(max_bytes))
+# --- Database statistics ---
+# DB_STATS counts, per collection and SQLiteCollection method, the calls, how many of them ran a full
+# table scan, rows scanned, rows decoded in Python, rows returned, bytes of JSON decoded and wall time.
+# Rows scanned are the rows SQLite handed back, or the table size when the plan is a full scan (an upper
+# bound when a LIMIT stops the scan early). Iterating a find() cursor is counted as 'find'. Reads from a
+# snapshot count under "snapshot.<collection>". The counters are served and reset at /api/debug/db-stats.
+DB_STAT_FIELDS = ('calls', 'full_scans', 'rows_scanned', 'rows_decoded', 'rows_returned', 'bytes_decoded', 'time_ms')
+QUERY_PLANS_MAX = 1024
+QUERY_PLANS = {}
+class DatabaseStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self.since = datetime.now(timezone.utc).isoformat()
+
+    def current(self):
+        """Returns the method being measured on this thread, or None outside an instrumented call."""
+        return getattr(self._local, 'method', None)
+
+    @contextmanager
+    def operation(self, collection, method):
+        """Attributes the work done in the block to collection.method; nested calls count toward the outer one."""
+        if self.current() is not None:
+            yield
+            return
+        self._local.method = method
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.method = None
+            self.add(collection, method, calls=1, time_ms=(time.perf_counter() - started) * 1000)
+
+    def add(self, collection, method, **counts):
+        with self._lock:
+            counters = self._counters.get((collection, method))
+            if counters is None:
+                counters = self._counters[(collection, method)] = dict.fromkeys(DB_STAT_FIELDS, 0)
+            for field, value in counts.items():
+                counters[field] += value
+
+    def report(self):
+        """Returns {collection: {method: counters}} with time_ms rounded for display."""
+        with self._lock:
+            report = {}
+            for (collection, method), counters in sorted(self._counters.items()):
+                report.setdefault(collection, {})[method] = {**counters, 'time_ms': round(counters['time_ms'], 3)}
+            return report
+DB_STATS = DatabaseStats()
+def instrumented(method):
+    """Measures a SQLiteCollection method in DB_STATS under its own name."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with DB_STATS.operation(self.stats_name, method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+def is_full_scan(conn, sql, params, table):
+    """True when the plan of sql reads all of table rather than searching an index; memoized per statement."""
+    full_scan = QUERY_PLANS.get(sql)
+    if full_scan is None:
+        if len(QUERY_PLANS) >= QUERY_PLANS_MAX:
+            QUERY_PLANS.clear()
+        details = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        # Before SQLite 3.24 the detail reads "SCAN TABLE <name>".
+        full_scan = QUERY_PLANS[sql] = any(
+            [word for word in detail.split() if word != 'TABLE'][:2] == ['SCAN', table] and 'USING' not in detail for detail in details
+        )
+    return full_scan
+def table_size(conn, table):
+    """Cheap row count estimate: the largest rowid, found through the rowid b-tree without a scan."""
+    return conn.execute(f"SELECT MAX(rowid) FROM main.{table}").fetchone()[0] or 0
+# --- Connection pool ---
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_SYNCHRONOUS = 'NORMAL'
+class SQLiteConnectionPool:
+    """Gives every thread its own sqlite3 connection to one database file running in WAL mode.
+
+    Waitress worker threads and the scheduler each read and write through their own connection, so
+    readers no longer queue behind a writer on a shared handle. The pool proxies the Connection
+    methods the code base uses, so it can be passed wherever a single connection was used before."""
+    def __init__(self, db_path, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS, synchronous=SQLITE_SYNCHRONOUS):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        # Where this database's monthly archives live and which months it has; None means ARCHIVE_DIR and
+        # ARCHIVE_MONTHS. A snapshot pool points both at its own copies.
+        self.archive_dir = None
+        self.archive_months = None
+        self._local = threading.local()
+        self.journal_mode = self.connection().execute("PRAGMA journal_mode = WAL").fetchone()[0]
+
+    def connection(self):
+        """Returns the calling thread's connection, opening and tuning it on first use."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+            connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+            connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+            connection.execute("PRAGMA temp_store = MEMORY")
+            connection.create_function('inflate', 1, inflate_document, deterministic=True)
+            self._local.connection = connection
+            self._local.attached = OrderedDict()
+        return connection
+
+    def close(self):
+        """Closes the calling thread's connection; the next call on this thread opens a fresh one."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            self._local.attached = OrderedDict()
+
+    def attach(self, path, schema):
+        """ATTACHes path as schema on the calling thread's connection; returns False when it cannot.
+
+        At most ARCHIVE_MAX_ATTACHED files stay attached, the least recently used is detached first.
+        SQLite refuses ATTACH and DETACH inside a transaction."""
+        connection = self.connection()
+        attached = self._local.attached
+        if schema in attached:
+            attached.move_to_end(schema)
+            return True
+        if self.in_transaction():
+            return False
+        if connection.in_transaction:
+            connection.commit()
+        try:
+            while len(attached) >= ARCHIVE_MAX_ATTACHED:
+                oldest = next(iter(attached))
+                connection.execute(f"DETACH DATABASE {oldest}")
+                del attached[oldest]
+            connection.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Could not attach {path}: {str(e)}")
+            return False
+        attached[schema] = path
+        return True
+
+    def attach_archives(self):
+        """Attaches the newest archived months, up to ARCHIVE_MAX_ATTACHED, so reads inside a transaction can use them."""
+        catalog = ARCHIVE_MONTHS if self.archive_months is None else self.archive_months
+        for month in sorted({month for months in catalog.values() for month in months})[-ARCHIVE_MAX_ATTACHED:]:
+            self.attach(archive_path(month, self.archive_dir), archive_schema(month))
+
+    def in_transaction(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def after_commit(self, callback):
+        """Runs callback when the calling thread's transaction ends (commit or rollback), or now outside one."""
+        if self.in_transaction():
+            self._local.callbacks.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def transaction(self, savepoint=True, archives=True):
+        """Groups every write made on this thread into one BEGIN IMMEDIATE ... COMMIT.
+
+        Collection methods skip their own commit while a transaction is open, so N writes cost one
+        fsync and either all land or none do. Nested transactions become savepoints; with
+        savepoint=False they join the open transaction instead, and a failure rolls back the whole of it.
+        Bulk writes use that: a savepoint journals every page the batch touches and makes large
+        re-imports several times slower. The newest archived months are attached first (see
+        attach_archives()); archives=False leaves the attachments alone, for the archiver."""
+        connection = self.connection()
+        depth = getattr(self._local, 'depth', 0)
+        if depth and not savepoint:
+            yield self
+            return
+        savepoint = f"tx_{depth}"
+        if depth == 0:
+            if connection.in_transaction:
+                connection.commit()
+            # ATTACH is refused once the transaction has begun.
+            if archives:
+                self.attach_archives()
+            connection.execute("BEGIN IMMEDIATE")
+            self._local.callbacks = []
+        else:
+            connection.execute(f"SAVEPOINT {savepoint}")
+        self._local.depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                connection.rollback()
+                self._run_callbacks()
+            else:
+                connection.execute(f"ROLLBACK TO {savepoint}")
+                connection.execute(f"RELEASE {savepoint}")
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            connection.commit()
+            self._run_callbacks()
+        else:
+            connection.execute(f"RELEASE {savepoint}")
+
+    def _run_callbacks(self):
+        callbacks, self._local.callbacks = self._local.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.connection().executemany(sql, seq_of_params)
+
+    def commit(self):
+        if not self.in_transaction():
+            self.connection().commit()
+
+    def rollback(self):
+        self.connection().rollback()
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 class SQLiteCollection:
-    def __init__(self, conn, name):
+    def __init__(self, conn, name, cached=True, archived=False, stats_name=None):
+        """archived makes reads without a date range include every archived month, as exports need.
+        stats_name is the name DB_STATS counts the collection's work under (the table name by default)."""
         self.conn = conn
         self.name = name
+        self.stats_name = stats_name or name
+        self.cached = cached
+        self.archived = archived
+        self.compressible = name in COMPRESSIBLE_COLLECTIONS
+        self.source = cold_source() if self.compressible else 'data'
+        self.columns = filter_columns(name)
+
+    def _compile_filter(self, filter_, months=()):
+        """Compiles filter_ for a read over the live table, or over the UNION with months, which has no typed columns."""
+        return compile_filter(filter_, self.source, None if months else self.columns)
+
+    def _set_data(self, expr):
+        """SET clause storing a full document; it also clears `packed`, so a written cold row is hot again."""
+        return f"data = {expr}, packed = NULL" if self.compressible else f"data = {expr}"
+
+    def _commit(self):
+        self.conn.commit()
+        self._invalidate()
+
+    def _invalidate(self):
+        """Drops the collection's cached documents once the current write is committed."""
+        cache = DOCUMENT_CACHES.get(self.name)
+        if cache is not None:
+            self.conn.after_commit(cache.invalidate)
+
+    def cache_info(self):
+        cache = DOCUMENT_CACHES.get(self.name)
+        return cache.info() if cache is not None else None
 
     def matches_filter(self, d, filter_):
-        if not filter_:
-            return True
-        for key, value in filter_.items():
-            if key == '$or':
-                if not any(self.matches_filter(d, subfilter) for subfilter in value):
-                    return False
-            else:
-                if d.get(key) != value:
-                    return False
-        return True
+        return document_matches(d, filter_)
+
+    def create_index(self, fields):
+        """Creates (if missing) an expression index on one field or a tuple of fields and records it in json_indexes."""
+        key = (fields,) if isinstance(fields, str) else tuple(fields)
+        runtime_indexes(self.conn)
+        self.conn.execute("INSERT OR IGNORE INTO json_indexes (collection, fields) VALUES (?, ?)", (self.name, json.dumps(list(key))))
+        name = create_json_index(self.conn, self.name, key)
+        self.conn.commit()
+        return name
+
+    def drop_index(self, name):
+        """Drops an index made by create_index() so it is not rebuilt on the next start."""
+        if not name.startswith(MANAGED_INDEX_PREFIX):
+            raise ValueError(f"{name} is not a managed JSON index")
+        for key in runtime_indexes(self.conn).get(self.name, []):
+            if index_name(self.name, key) == name:
+                self.conn.execute("DELETE FROM json_indexes WHERE collection = ? AND fields = ?", (self.name, json.dumps(list(key))))
+        self.conn.execute(f"DROP INDEX IF EXISTS {name}")
+        self.conn.commit()
+
+    def index_information(self):
+        return list_indexes(self.conn, self.name).get(self.name, {})
+
+    def _select(self, filter_, limit=None, projection=None, sort=None, skip=0, batch_size=None):
+        """Yields (id, document) for rows matching filter_, served from the document cache when enabled.
+
+        Reads inside a transaction bypass the cache so uncommitted documents are never shared."""
+        cache = DOCUMENT_CACHES.get(self.name) if self.cached else None
+        if cache is None or self.conn.in_transaction():
+            yield from self._query(filter_, limit, projection, sort, skip, batch_size)
+            return
+        key = cache_key(filter_, limit, projection, sort, skip)
+        rows = cache.get(key)
+        if rows is None:
+            generation = cache.generation
+            rows = list(self._query(filter_, limit, projection, sort, skip, batch_size))
+            cache.put(key, rows, generation)
+        yield from rows
+
+    def _archive_groups(self, filter_):
+        """Splits the archived months filter_ reaches into groups that can be attached together."""
+        months = archive_span(self.name, filter_, self.conn.archive_months, include_all=self.archived)
+        return [months[i:i + ARCHIVE_MAX_ATTACHED] for i in range(0, len(months), ARCHIVE_MAX_ATTACHED)] or [[]]
+
+    def _from_sql(self, months=(), live=True):
+        """FROM target covering the live table (unless live is False) and the given archived months.
+
+        Raises RuntimeError when a month cannot be attached, e.g. an older one inside a transaction,
+        rather than reading without it."""
+        if not months:
+            return self.name
+        columns = archive_columns(self.name)
+        parts = [f"SELECT {columns} FROM main.{self.name}"] if live else []
+        for month in months:
+            schema = archive_schema(month)
+            if not self.conn.attach(archive_path(month, self.conn.archive_dir), schema):
+                raise RuntimeError(f"Cannot read the {month} archive of {self.name}"
+                                   + (" inside a transaction" if self.conn.in_transaction() else ''))
+            parts.append(f"SELECT {columns} FROM {schema}.{self.name}")
+        return f"({' UNION ALL '.join(parts)}) AS {self.name}"
+
+    def _query_partitions(self, groups, filter_, limit, projection, sort, skip, batch_size):
+        """Reads the groups of archived months one after another, since only one group can be attached at a time.
+
+        Unsorted reads stream each group in turn. Sorted reads let SQLite sort each group and merge the
+        results; those have to be buffered, at most skip + limit rows per group when there is a limit."""
+        end = None if limit is None else skip + int(limit)
+        if not sort:
+            rows = chain.from_iterable(
+                self._query(filter_, projection=projection, batch_size=batch_size, partition=(months, position == 0))
+                for position, months in enumerate(groups)
+            )
+            yield from islice(rows, skip, end)
+            return
+        with DB_STATS.operation(self.stats_name, 'find'):
+            runs = [
+                list(self._query(filter_, limit=end, sort=sort, batch_size=batch_size, partition=(months, position == 0)))
+                for position, months in enumerate(groups)
+            ]
+        spec = parse_projection(projection)
+        for row_id, d in islice(heapq.merge(*runs, key=lambda row: SortKey(row, sort)), skip, end):
+            yield row_id, (d if spec is None else apply_projection(d, spec))
 
+    def _query(self, filter_, limit=None, projection=None, sort=None, skip=0, batch_size=None, partition=None):
+        """Yields (id, document) for rows matching filter_; only rows passing the SQL part are decoded.
+
+        With a projection and no residual filter, SQLite builds the reduced document so only the
+        requested fields are ever parsed in Python. Sorting always runs in SQL; skip and limit do
+        too unless a residual Python filter has to see the rows first. partition is (months, live)
+        when reading one group of a span over more archived months than can be attached at once."""
+        if partition is None:
+            groups = self._archive_groups(filter_)
+            if len(groups) > 1:
+                yield from self._query_partitions(groups, filter_, limit, projection, sort, skip, batch_size)
+                return
+            partition = (groups[0], True)
+        clauses, params, residual = self._compile_filter(filter_, partition[0])
+        spec = parse_projection(projection)
+        column = stored = doc_text()
+        if spec is not None and residual is None:
+            column = projection_column(spec) or stored
+        python_projection = spec is not None and column == stored
+        packed = ', NULL'
+        if self.compressible:
+            column, packed = f"CASE WHEN packed IS NULL THEN {column} END", ', packed'
+        sql = f"SELECT id, {column}{packed} FROM {self._from_sql(*partition)}" + where_sql(clauses) + sort_sql(sort)
+        pending_skip, remaining = skip, limit
+        if residual is None:
+            if limit is not None or skip:
+                sql += " LIMIT ? OFFSET ?"
+                params = params + [-1 if limit is None else int(limit), int(skip)]
+            pending_skip, remaining = 0, None
+        if remaining is not None and remaining <= 0:
+            return
+        match = compile_matcher(residual) if residual else None
+        method = DB_STATS.current()
+        started, elapsed = time.perf_counter(), 0.0
+        scanned = returned = size = 0
+        full_scan = is_full_scan(self.conn, sql, params, self.name)
+        cur = self.conn.execute(sql, params)
+        try:
+            for row_id, row_data, row_packed in iter_rows(cur, batch_size or DEFAULT_BATCH_SIZE):
+                scanned += 1
+                if row_packed is not None:
+                    text = inflate_document(row_packed)
+                    d = loads_json(text)
+                    if spec is not None and not python_projection:
+                        d.setdefault('_id', row_id)
+                        d = apply_projection(d, spec)
+                else:
+                    text = row_data
+                    d = loads_json(row_data)
+                size += len(text)
+                d.setdefault('_id', row_id)
+                if match is not None and not match(d):
+                    continue
+                if pending_skip:
+                    pending_skip -= 1
+                    continue
+                if python_projection:
+                    d = apply_projection(d, spec)
+                elif spec is not None:
+                    if spec[2]:
+                        d = {'_id': row_id, **d}
+                    else:
+                        d.pop('_id', None)
+                returned += 1
+                elapsed += time.perf_counter() - started
+                started = None
+                yield row_id, d
+                started = time.perf_counter()
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining <= 0:
+                        return
+        finally:
+            cur.close()
+            if started is not None:
+                elapsed += time.perf_counter() - started
+            # A stream over several groups of archived months is one call, counted with the first group.
+            counts = {'calls': int(partition[1]), 'time_ms': elapsed * 1000} if method is None else {}
+            DB_STATS.add(
+                self.stats_name, method or 'find', full_scans=int(full_scan), rows_scanned=max(scanned, table_size(self.conn, self.name)) if full_scan else scanned,
+                rows_decoded=scanned, rows_returned=returned, bytes_decoded=size, **counts
+            )
+
+    def find_raw(self, filter=None, sort=None, batch_size=None):
+        """Yields matching documents as their stored JSON text, with _id filled in, without decoding them in Python."""
+        groups = self._archive_groups(filter)
+        clauses, params, residual = self._compile_filter(filter, groups[0])
+        if residual is not None or len(groups) > 1:
+            for _, d in self._select(filter, sort=sort, batch_size=batch_size):
+                yield dumps_json(d)
+            return
+        sql = f"SELECT json_insert({self.source}, '$._id', id) FROM {self._from_sql(groups[0])}" + where_sql(clauses) + sort_sql(sort)
+        started, elapsed, returned = time.perf_counter(), 0.0, 0
+        full_scan = is_full_scan(self.conn, sql, params, self.name)
+        cur = self.conn.execute(sql, params)
+        try:
+            for (text,) in iter_rows(cur, batch_size or DEFAULT_BATCH_SIZE):
+                returned += 1
+                elapsed += time.perf_counter() - started
+                started = None
+                yield text
+                started = time.perf_counter()
+        finally:
+            cur.close()
+            if started is not None:
+                elapsed += time.perf_counter() - started
+            DB_STATS.add(
+                self.stats_name, 'find_raw', calls=1, time_ms=elapsed * 1000, full_scans=int(full_scan),
+                rows_scanned=max(returned, table_size(self.conn, self.name)) if full_scan else returned, rows_returned=returned
+            )
+
+    def _count(self, filter_, limit=None, skip=0):
+        with DB_STATS.operation(self.stats_name, 'count'):
+            groups = self._archive_groups(filter_)
+            if self._compile_filter(filter_, groups[0])[2] is not None:
+                return sum(1 for _ in self._select(filter_, limit=limit, skip=skip))
+            if len(groups) == 1:
+                return self._count_sql(filter_, groups[0], True, limit, skip)
+            count = max(sum(self._count_sql(filter_, months, position == 0) for position, months in enumerate(groups)) - int(skip), 0)
+            return count if limit is None else min(count, int(limit))
+
+    def _count_sql(self, filter_, months, live, limit=None, skip=0):
+        """COUNT(*) of the rows matching filter_ in the live table (unless live is False) and months."""
+        clauses, params, _ = self._compile_filter(filter_, months)
+        sql = f"SELECT 1 FROM {self._from_sql(months, live)}" + where_sql(clauses)
+        if limit is not None or skip:
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else int(limit), int(skip)]
+        sql = f"SELECT COUNT(*) FROM ({sql})"
+        full_scan = is_full_scan(self.conn, sql, params, self.name)
+        count = self.conn.execute(sql, params).fetchone()[0]
+        DB_STATS.add(
+            self.stats_name, DB_STATS.current(), full_scans=int(full_scan),
+            rows_scanned=max(count, table_size(self.conn, self.name)) if full_scan else count
+        )
+        return count
+
+    def _select_live(self, filter_, limit=None):
+        """Yields (id, document) for matching rows of the live table; writes never reach the archived months."""
+        return self._query(filter_, limit, partition=((), True))
+
+    def _select_one(self, filter_, projection=None, live=False):
+        rows = self._select_live(filter_, limit=1) if live else self._select(filter_, limit=1, projection=projection)
+        try:
+            return next(rows, None)
+        finally:
+            rows.close()
+
+    def _first_id(self, filter_):
+        """Returns the id of the first matching row without decoding it when SQL decides the match."""
+        clauses, params, residual = self._compile_filter(filter_)
+        if residual is not None:
+            match = self._select_one(filter_, live=True)
+            return match[0] if match else None
+        sql = f"SELECT id FROM {self.name}" + where_sql(clauses)
+        row = self.conn.execute(sql + " LIMIT 1", params).fetchone()
+        return row[0] if row else None
+
+    @instrumented
     def insert_one(self, doc):
         if '_id' not in doc:
             doc['_id'] = str(uuid.uuid4())
-        json_doc = json.dumps(document_to_dict(doc))
+        json_doc = dumps_json(doc)
         cur = self.conn.cursor()
-        cur.execute(f"INSERT INTO {self.name} (id, data) VALUES (?, ?)", (doc['_id'], json_doc))
-        self.conn.commit()
+        cur.execute(f"INSERT INTO {self.name} (id, data) VALUES (?, {doc_param()})", (doc['_id'], json_doc))
+        self._commit()
         return type('InsertResult', (), {'inserted_id': doc['_id']})()
 
-    def find(self, filter=None):
-        cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT data FROM {self.name}").fetchall()
-        docs = [json.loads(row[0]) for row in rows]
-        if filter:
-            docs = [d for d in docs if self.matches_filter(d, filter)]
-        return docs
-
-    def find_one(self, filter):
-        rows = self.conn.execute(f"SELECT data FROM {self.name}").fetchall()
-        for row in rows:
-            d = json.loads(row[0])
-            if self.matches_filter(d, filter):
-                return d
-        return None
+    def find(self, filter=None, projection=None):
+        return SQLiteCursor(self, filter, projection)
+
+    @instrumented
+    def count_documents(self, filter=None):
+        return self._count(filter)
+
+    @instrumented
+    def aggregate(self, pipeline):
+        """Runs an aggregation pipeline and returns the resulting documents as a list.
+
+        Pipelines of the form $match, $unwind, $group, $sort, $limit (each optional) run in SQLite;
+        anything else runs the leading $match in SQL and the remaining stages in Python."""
+        plan = pipeline_plan(pipeline)
+        if plan is not None and '$group' not in plan:
+            cursor = self.find(plan.get('$match'))
+            if '$sort' in plan:
+                cursor.sort(list(plan['$sort'].items()))
+            if '$limit' in plan:
+                cursor.limit(int(plan['$limit']))
+            return list(cursor)
+        results = self._aggregate_sql(plan) if plan is not None else None
+        if results is not None:
+            return results
+        stages = list(pipeline)
+        filter_ = stages.pop(0)['$match'] if stages and list(stages[0]) == ['$match'] else None
+        return aggregate_documents(self.find(filter_), stages)
+
+    def _reads_line_items(self, prefix, spec):
+        """True when a $group over the unwound prefix only reads fields that <table>_line_items stores as columns.
+
+        The line item table holds the object elements of the array, which is what the app writes there."""
+        typed = TYPED_COLLECTIONS.get(self.name)
+        if typed is None or typed['line_items'] != prefix:
+            return False
+        key_spec = spec.get('_id')
+        exprs = list(key_spec.values()) if isinstance(key_spec, dict) else [key_spec]
+        exprs.extend(next(iter(accumulator.values())) for name, accumulator in spec.items() if name != '_id')
+        for expr in exprs:
+            path = field_reference(expr)
+            if path is not None and (path == prefix or path.startswith(prefix + '.')) and path[len(prefix) + 1:] not in LINE_ITEM_FIELDS:
+                return False
+        return True
+
+    def _aggregate_sql(self, plan):
+        """Runs a planned $group pipeline as one statement; None when part of it has to run in Python."""
+        groups = self._archive_groups(plan.get('$match'))
+        clauses, params, residual = self._compile_filter(plan.get('$match'), groups[0])
+        if residual is not None or len(groups) > 1:
+            return None
+        prefix = unwind_path(plan['$unwind']) if '$unwind' in plan else None
+        line_items = prefix is not None and not groups[0] and self._reads_line_items(prefix, plan['$group'])
+
+        def operand(expr, select_params):
+            path = field_reference(expr)
+            if path is None:
+                select_params.append(expr)
+                return '?'
+            if prefix is not None and (path == prefix or path.startswith(prefix + '.')):
+                rest = path[len(prefix) + 1:]
+                if line_items:
+                    return f"u.{rest}"
+                return json_field_sql(rest, 'u.value') if rest else 'u.value'
+            return 'id' if path == '_id' else json_field_sql(path, self.source)
+
+        spec = plan['$group']
+        key_spec = spec.get('_id')
+        keys = list(key_spec.items()) if isinstance(key_spec, dict) else [(None, key_spec)]
+        columns, select_params, aliases = [], [], {}
+        for position, (name, expr) in enumerate(keys):
+            columns.append(f"{operand(expr, select_params)} AS _g{position}")
+            aliases['_id' if name is None else f"_id.{name}"] = f"_g{position}"
+        aliases.setdefault('_id', ', '.join(f"_g{i}" for i in range(len(keys))))
+        accumulators = [name for name in spec if name != '_id']
+        for name in accumulators:
+            (op, expr), = spec[name].items()
+            if op == '$count':
+                column = 'COUNT(*)'
+            elif op == '$sum':
+                column = f"COALESCE(SUM({operand(expr, select_params)}), 0)"
+            else:
+                column = f"{GROUP_ACCUMULATORS[op]}({operand(expr, select_params)})"
+            columns.append(f"{column} AS {quote_identifier(name)}")
+            aliases[name] = quote_identifier(name)
+        order = []
+        for field, direction in (plan.get('$sort') or {}).items():
+            if field not in aliases:
+                return None
+            order.extend(f"{alias} {'DESC' if direction < 0 else 'ASC'}" for alias in aliases[field].split(', '))
+        source = self._from_sql(groups[0])
+        if line_items:
+            # CROSS JOIN keeps the collection as the outer loop, so the filter's index narrows it first.
+            source += f" CROSS JOIN {line_items_table(self.name)} AS u ON u.parent_id = {self.name}.id"
+        elif prefix is not None:
+            source += f", json_each({self.source}, {sql_literal(json_path(prefix))}) AS u"
+        sql = f"SELECT {', '.join(columns)} FROM {source}" + where_sql(clauses)
+        sql += " GROUP BY " + ', '.join(f"_g{i}" for i in range(len(keys)))
+        if order:
+            sql += " ORDER BY " + ', '.join(order)
+        params = select_params + params
+        if '$limit' in plan:
+            sql += " LIMIT ?"
+            params.append(int(plan['$limit']))
+        full_scan = is_full_scan(self.conn, sql, params, self.name)
+        results = []
+        for row in self.conn.execute(sql, params):
+            key = {name: row[i] for i, (name, _) in enumerate(keys)} if isinstance(key_spec, dict) else row[0]
+            results.append({'_id': key, **dict(zip(accumulators, row[len(keys):]))})
+        DB_STATS.add(
+            self.stats_name, DB_STATS.current() or 'aggregate', full_scans=int(full_scan),
+            rows_scanned=table_size(self.conn, self.name) if full_scan else 0, rows_returned=len(results)
+        )
+        return results
+
+    def changes_since(self, seq, limit=CHANGE_LOG_PAGE):
+        return changes_since(self.conn, seq, [self.name], limit)
+
+    @instrumented
+    def find_one(self, filter, projection=None):
+        match = self._select_one(filter, projection)
+        return match[1] if match else None
+
+    def _update_in_place(self, filter_, update, compiled, many):
+        """Runs a compiled update as UPDATE ... SET data = json_set(...) without decoding documents in Python.
+
+        Returns the modified count, or None when a matched document needs the Python path."""
+        expr, update_params = compiled
+        clauses, params, residual = self._compile_filter(filter_)
+        guard = non_numeric_condition(update, self.source)
+        if guard is not None:
+            if residual is not None:
+                return None
+            if self.conn.execute(f"SELECT 1 FROM {self.name}{where_sql(clauses + [f'({guard})'])} LIMIT 1", params).fetchone():
+                return None
+        if residual is None:
+            if many:
+                sql = f"UPDATE {self.name} SET {self._set_data(expr)}" + where_sql(clauses)
+            else:
+                sql = f"UPDATE {self.name} SET {self._set_data(expr)} WHERE id IN (SELECT id FROM {self.name}{where_sql(clauses)} LIMIT 1)"
+            cur = self.conn.execute(sql, update_params + params)
+        else:
+            ids = [row_id for row_id, _ in self._select_live(filter_, limit=None if many else 1)]
+            cur = self.conn.executemany(
+                f"UPDATE {self.name} SET {self._set_data(expr)} WHERE id = ?", [update_params + [row_id] for row_id in ids]
+            )
+        self._commit()
+        return max(cur.rowcount, 0)
 
+    @instrumented
     def update_one(self, filter, update, array_filters=None):
+        compiled = None if array_filters else compile_update(update, self.source)
+        count = None if compiled is None else self._update_in_place(filter, update, compiled, many=False)
+        if count is not None:
+            return type('UpdateResult', (), {'matched_count': count, 'modified_count': count})()
         cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT id, data FROM {self.name}").fetchall()
-        matched = False
-        for row_id, row_data in rows:
-            d = json.loads(row_data)
-            if self.matches_filter(d, filter):
-                matched = True
-                if '$set' in update:
-                    for k, v in update['$set'].items():
-                        if '.' in k:
-                            parts = k.split('.')
-                            current = d
-                            for part in parts[:-1]:
-                                if part.isdigit():
-                                    part = int(part)
-                                if part not in current:
-                                    current[part] = {} if not part.isdigit() else []
-                                current = current[part]
-                            current[parts[-1]] = v
-                        else:
-                            d[k] = v
-                if '$unset' in update:
-                    for k in update['$unset']:
-                        if '.' in k:
-                            parts = k.split('.')
-                            current = d
-                            for part in parts[:-1]:
-                                if part.isdigit():
-                                    part = int(part)
-                                current = current[part]
-                            current.pop(parts[-1], None)
-                        else:
-                            d.pop(k, None)
-                if '$inc' in update:
-                    for k, v in update['$inc'].items():
-                        if '.' in k:
-                            parts = k.split('.')
-                            current = d
-                            for part in parts[:-1]:
-                                if part.isdigit():
-                                    part = int(part)
-                                if part not in current:
-                                    current[part] = {} if not part.isdigit() else []
-                                current = current[part]
-                            current[parts[-1]] = current.get(parts[-1], 0) + v
-                        else:
-                            d[k] = d.get(k, 0) + v
-                if '$pull' in update:
-                    for k, v in update['$pull'].items():
-                        if isinstance(d.get(k), list):
-                            d[k] = [i for i in d[k] if i != v]
-                if array_filters:
-                    for uk, uv in update['$set'].items():
-                        if '$[elem]' in uk:
-                            array_name, rest = uk.split('.$[elem].', 1)
-                            array = d.get(array_name, [])
-                            af = array_filters[0]
-                            af_key = list(af.keys())[0].split('.')[-1]
-                            af_value = af[list(af.keys())[0]]
-                            for elem in array:
-                                if elem.get(af_key) == af_value:
-                                    elem[rest] = uv
-                json_doc = json.dumps(document_to_dict(d))
-                cur.execute(f"UPDATE {self.name} SET data = ? WHERE id = ?", (json_doc, row_id))
-                self.conn.commit()
-                return type('UpdateResult', (), {'matched_count': 1, 'modified_count': 1})()
-        return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 0})()
+        match = self._select_one(filter, live=True)
+        if match is None:
+            return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 0})()
+        row_id, d = match
+        apply_update(d, update, filter, array_filters)
+        json_doc = dumps_json(d)
+        cur.execute(f"UPDATE {self.name} SET {self._set_data(doc_param())} WHERE id = ?", (json_doc, row_id))
+        self._commit()
+        count = max(cur.rowcount, 0)
+        return type('UpdateResult', (), {'matched_count': count, 'modified_count': count})()
 
+    @instrumented
     def update_many(self, filter, update):
+        compiled = compile_update(update, self.source)
+        count = None if compiled is None else self._update_in_place(filter, update, compiled, many=True)
+        if count is not None:
+            return type('UpdateResult', (), {'matched_count': count, 'modified_count': count})()
         cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT id, data FROM {self.name}").fetchall()
+        rows = list(self._select_live(filter))
         modified_count = 0
-        for row_id, row_data in rows:
-            d = json.loads(row_data)
-            if self.matches_filter(d, filter):
-                if '$set' in update:
-                    for k, v in update['$set'].items():
-                        if '.' in k:
-                            parts = k.split('.')
-                            current = d
-                            for part in parts[:-1]:
-                                if part.isdigit():
-                                    part = int(part)
-                                if part not in current:
-                                    current[part] = {} if not part.isdigit() else []
-                                current = current[part]
-                            current[parts[-1]] = v
-                        else:
-                            d[k] = v
-                json_doc = json.dumps(document_to_dict(d))
-                cur.execute(f"UPDATE {self.name} SET data = ? WHERE id = ?", (json_doc, row_id))
-                modified_count += 1
-        self.conn.commit()
-        return type('UpdateResult', (), {'modified_count': modified_count})()
+        for row_id, d in rows:
+            apply_update(d, update, filter)
+            json_doc = dumps_json(d)
+            cur.execute(f"UPDATE {self.name} SET {self._set_data(doc_param())} WHERE id = ?", (json_doc, row_id))
+            modified_count += max(cur.rowcount, 0)
+        self._commit()
+        return type('UpdateResult', (), {'matched_count': modified_count, 'modified_count': modified_count})()
 
+    @instrumented
+    def insert_many(self, docs):
+        rows = []
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = str(uuid.uuid4())
+            rows.append((doc['_id'], dumps_json(doc)))
+        with self.conn.transaction(savepoint=False):
+            self.conn.executemany(f"INSERT INTO {self.name} (id, data) VALUES (?, {doc_param()})", rows)
+        self._invalidate()
+        return type('InsertManyResult', (), {'inserted_ids': [row_id for row_id, _ in rows]})()
+
+    @instrumented
+    def update_many_by_ids(self, ids, update):
+        """Applies update to the documents with the given ids using executemany in one transaction."""
+        ids = [str(row_id) for row_id in ids]
+        compiled = compile_update(update, self.source)
+        guard = non_numeric_condition(update, self.source)
+        with self.conn.transaction(savepoint=False):
+            if compiled is not None and guard is not None:
+                for start in range(0, len(ids), BULK_ID_CHUNK):
+                    chunk = ids[start:start + BULK_ID_CHUNK]
+                    sql = f"SELECT 1 FROM {self.name} WHERE id IN ({', '.join('?' * len(chunk))}) AND ({guard}) LIMIT 1"
+                    if self.conn.execute(sql, chunk).fetchone():
+                        compiled = None
+                        break
+            if compiled is not None:
+                expr, update_params = compiled
+                cur = self.conn.executemany(
+                    f"UPDATE {self.name} SET {self._set_data(expr)} WHERE id = ?", [update_params + [row_id] for row_id in ids]
+                )
+                count = max(cur.rowcount, 0)
+            else:
+                rows = []
+                for start in range(0, len(ids), BULK_ID_CHUNK):
+                    for row_id, d in self._select_live({'_id': {'$in': ids[start:start + BULK_ID_CHUNK]}}):
+                        apply_update(d, update)
+                        rows.append((dumps_json(d), row_id))
+                cur = self.conn.executemany(f"UPDATE {self.name} SET {self._set_data(doc_param())} WHERE id = ?", rows)
+                count = max(cur.rowcount, 0)
+        self._invalidate()
+        return type('UpdateResult', (), {'matched_count': count, 'modified_count': count})()
+
+    @instrumented
+    def bulk_write(self, operations):
+        """Runs InsertOne/ReplaceOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany operations in one transaction.
+
+        Returns a BulkWriteResult with totals and `results`, the per-operation result objects in order.
+        Any failure rolls back the whole batch; inside an open transaction, it rolls back that transaction."""
+        writer = BulkWriter(self)
+        with self.conn.transaction(savepoint=False):
+            results = [writer.execute(operation) for operation in operations]
+            writer.flush()
+        self._invalidate()
+        return type('BulkWriteResult', (), {
+            'results': results,
+            'inserted_count': sum(1 for r in results if hasattr(r, 'inserted_id')),
+            'matched_count': sum(getattr(r, 'matched_count', 0) for r in results),
+            'modified_count': sum(getattr(r, 'modified_count', 0) for r in results if getattr(r, 'upserted_id', None) is None),
+            'deleted_count': sum(getattr(r, 'deleted_count', 0) for r in results),
+            'upserted_ids': {i: r.upserted_id for i, r in enumerate(results) if getattr(r, 'upserted_id', None) is not None},
+        })()
+
+    @instrumented
     def delete_one(self, filter):
         cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT id, data FROM {self.name}").fetchall()
-        for row_id, row_data in rows:
-            d = json.loads(row_data)
-            if self.matches_filter(d, filter):
-                cur.execute(f"DELETE FROM {self.name} WHERE id = ?", (row_id,))
-                self.conn.commit()
-                return type('DeleteResult', (), {'deleted_count': 1})()
+        row_id = self._first_id(filter)
+        if row_id is not None:
+            cur.execute(f"DELETE FROM {self.name} WHERE id = ?", (row_id,))
+            self._commit()
+            return type('DeleteResult', (), {'deleted_count': 1})()
         return type('DeleteResult', (), {'deleted_count': 0})()
 
+    @instrumented
     def replace_one(self, filter, replacement, upsert=False):
         cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT id, data FROM {self.name}").fetchall()
-        matched = False
-        for row_id, row_data in rows:
-            d = json.loads(row_data)
-            if self.matches_filter(d, filter):
-                matched = True
-                json_doc = json.dumps(document_to_dict(replacement))
-                cur.execute(f"UPDATE {self.name} SET data = ? WHERE id = ?", (json_doc, row_id))
-                self.conn.commit()
-                return type('UpdateResult', (), {'matched_count': 1, 'modified_count': 1})()
+        row_id = self._first_id(filter)
+        if row_id is not None:
+            json_doc = dumps_json(replacement)
+            cur.execute(f"UPDATE {self.name} SET {self._set_data(doc_param())} WHERE id = ?", (json_doc, row_id))
+            self._commit()
+            return type('UpdateResult', (), {'matched_count': 1, 'modified_count': 1})()
         if upsert:
             self.insert_one(replacement)
             return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 1})()
         return type('UpdateResult', (), {'matched_count': 0, 'modified_count': 0})()
 
+    @instrumented
     def find_one_and_update(self, filter, update, upsert=False, return_document=True):
         cur = self.conn.cursor()
-        rows = cur.execute(f"SELECT id, data FROM {self.name}").fetchall()
-        matched = False
-        for row_id, row_data in rows:
-            d = json.loads(row_data)
-            if self.matches_filter(d, filter):
-                matched = True
-                old_d = d.copy()
-                if '$inc' in update:
-                    for k, v in update['$inc'].items():
-                        d[k] = d.get(k, 0) + v
-                json_doc = json.dumps(document_to_dict(d))
-                cur.execute(f"UPDATE {self.name} SET data = ? WHERE id = ?", (json_doc, row_id))
-                self.conn.commit()
-                if return_document:
-                    return d
-                else:
-                    return old_d
+        match = self._select_one(filter, live=True)
+        if match:
+            row_id, d = match
+            old_d = d.copy()
+            if '$inc' in update:
+                for k, v in update['$inc'].items():
+                    d[k] = d.get(k, 0) + v
+            json_doc = dumps_json(d)
+            cur.execute(f"UPDATE {self.name} SET {self._set_data(doc_param())} WHERE id = ?", (json_doc, row_id))
+            self._commit()
+            if return_document:
+                return d
+            else:
+                return old_d
         if upsert:
             doc = filter.copy()
             if '$inc' in update:
@@ -301,12 +2583,115 @@ class SQLiteCollection:
             self.insert_one(doc)
             return doc
         return None
+
+    @instrumented
+    def next_sequence(self, counter_id, field='count', step=1):
+        """Atomically increments field on the counter document counter_id, creating it on first use.
+
+        A single INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement looks the counter up by
+        primary key, so concurrent callers never see the same value. Before SQLite 3.35, which has no
+        RETURNING, the upsert and the read of the new value share one BEGIN IMMEDIATE instead."""
+        path = sql_literal(json_path(field))
+        sql = (
+            f"INSERT INTO {self.name} (id, data) VALUES (?, {json_writer('object')}('_id', ?, {sql_literal(field)}, ?)) "
+            f"ON CONFLICT(id) DO UPDATE SET data = {json_writer('set')}(data, {path}, COALESCE(json_extract(data, {path}), 0) + ?)"
+        )
+        params = (counter_id, counter_id, step, step)
+        if SQLITE_HAS_RETURNING:
+            value = self.conn.execute(sql + f" RETURNING json_extract(data, {path})", params).fetchone()[0]
+            self._commit()
+            return value
+        with self.conn.transaction(archives=False):
+            self.conn.execute(sql, params)
+            value = self.conn.execute(f"SELECT json_extract(data, {path}) FROM {self.name} WHERE id = ?", (counter_id,)).fetchone()[0]
+        self._invalidate()
+        return value
+class SQLiteCursor:
+    """Lazy result of SQLiteCollection.find(); sort(), skip() and limit() are compiled into the SQL query.
+
+    Iterating an unevaluated cursor streams documents from SQLite in batches of batch_size. len(),
+    indexing and truthiness still behave like the list find() used to return, running the query once
+    and keeping the documents for later access."""
+    def __init__(self, collection, filter_=None, projection=None):
+        self.collection = collection
+        self.filter = filter_
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = None
+        self._batch_size = DEFAULT_BATCH_SIZE
+        self._docs = None
+
+    def _check_unevaluated(self):
+        if self._docs is not None:
+            raise RuntimeError("Cannot modify a cursor after it has been iterated")
+
+    def sort(self, key_or_list, direction=1):
+        self._check_unevaluated()
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, count):
+        self._check_unevaluated()
+        self._skip = max(int(count), 0)
+        return self
+
+    def limit(self, count):
+        self._check_unevaluated()
+        self._limit = int(count) or None
+        return self
+
+    def batch_size(self, count):
+        self._check_unevaluated()
+        self._batch_size = max(int(count), 1)
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return self.collection._count(self.filter, self._limit, self._skip)
+        return self.collection._count(self.filter)
+
+    def _rows(self):
+        return self.collection._select(
+            self.filter, limit=self._limit, projection=self.projection, sort=self._sort, skip=self._skip,
+            batch_size=self._batch_size
+        )
+
+    def _materialize(self):
+        if self._docs is None:
+            self._docs = [d for _, d in self._rows()]
+        return self._docs
+
+    def __iter__(self):
+        if self._docs is not None:
+            return iter(self._docs)
+        return self._stream()
+
+    def _stream(self):
+        # list(cursor) calls len() between iter() and the first next(); reuse what len() fetched.
+        if self._docs is not None:
+            yield from self._docs
+            return
+        for _, d in self._rows():
+            yield d
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def __getitem__(self, index):
+        return self._materialize()[index]
+
+    def __bool__(self):
+        return bool(self._materialize())
 def connect_to_sqlite():
     global conn, items_collection, customers_collection, sales_collection, tables_collection, users_collection, settings_collection, email_tokens_collection, opening_collection, pos_closing_collection, kitchens_collection, item_groups_collection, kitchen_saved_collection, picked_up_collection, variants_collection, employees_collection, activeorders_collection, order_counters_collection, tripreports_collection, email_settings_collection, purchase_items_collection, suppliers_collection, purchase_orders_collection, purchase_receipts_collection, purchase_invoices_collection, uoms_collection, purchase_sales_collection, print_settings_collection, combo_offers_collection, vat_collection, customer_groups_collection, company_details_collection
     mode = config.get("mode", "server")
     if mode == 'server':
         db_path = os.path.join(CONFIG_DIR, 'restaurant.db')
-        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn = SQLiteConnectionPool(db_path)
         cur = conn.cursor()
         tables = [
             'active_orders', 'combo_offers', 'customers', 'email_settings', 'email_tokens', 'employees', 'item_groups', 'items', 'kitchen_saved_orders', 'kitchens',
@@ -316,7 +2701,17 @@ def connect_to_sqlite():
         for table in tables:
             cur.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, data TEXT)")
         conn.commit()
-        logger.info(f"Successfully connected to SQLite at {db_path}")
+        storage_format = ensure_storage_format(conn, tables, config.get('storage_format', 'text'))
+        indexes = ensure_indexes(conn)
+        logger.info(f"Ensured {len(indexes)} JSON field indexes")
+        ensure_compression_schema(conn)
+        ensure_archive_schema(conn)
+        ensure_typed_schema(conn)
+        ensure_change_log(conn, tables)
+        ensure_menu_search(conn)
+        if config.get('document_cache', True):
+            enable_document_cache()
+        logger.info(f"Successfully connected to SQLite at {db_path} (journal_mode={conn.journal_mode}, storage={storage_format})")
         items_collection = SQLiteCollection(conn, 'items')
         customers_collection = SQLiteCollection(conn, 'customers')
         sales_collection = SQLiteCollection(conn, 'sales')
@@ -386,6 +2781,29 @@ def db_required(f):
             return jsonify({"error": error_msg, "message": "Database not connected."}), 503
         return f(*args, **kwargs)
     return decorated_function
+class TransactionRollback(Exception):
+    def __init__(self, result):
+        super().__init__("Request returned an error response")
+        self.result = result
+def response_status(result):
+    if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], int):
+        return result[1]
+    return getattr(result, 'status_code', 200)
+def transactional(f):
+    """Runs a request handler as one unit of work: a single commit, rolled back on an error response or exception."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if conn is None or config.get("mode", "server") == 'client':
+            return f(*args, **kwargs)
+        try:
+            with conn.transaction():
+                result = f(*args, **kwargs)
+                if response_status(result) >= 400:
+                    raise TransactionRollback(result)
+                return result
+        except TransactionRollback as rollback:
+            return rollback.result
+    return decorated_function
 # Proxy for client mode - Add this to proxy all /api/* except local ones
 if config.get('mode') == 'client':
     @app.route('/api/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
@@ -442,13 +2860,46 @@ def sanitize_image_fields(data):
             combo['combo_image'] = os.path.basename(combo['combo_image'])
     return data
 def convert_objectid_to_str(item):
-    if isinstance(item, list):
-        return [convert_objectid_to_str(i) for i in item]
-    if isinstance(item, dict):
-        return {key: convert_objectid_to_str(value) for key, value in item.items()}
-    if isinstance(item, datetime):
-        return item.isoformat()
+    """Materializes find() cursors; datetimes are left to the JSON codec, so documents pass through as-is."""
+    if isinstance(item, SQLiteCursor):
+        return list(item)
     return item
+def json_array_response(documents, prefix='', suffix='', status=200, label=None):
+    """Streams JSON document texts (e.g. from find_raw) as one JSON array, optionally wrapped in prefix/suffix.
+
+    The first chunk is built before returning, so query errors still surface inside the handler's try block.
+    With label, logs "Fetched <n> <label>" once the last document has been streamed."""
+    def chunks():
+        count = 0
+        while True:
+            batch = list(islice(documents, DEFAULT_BATCH_SIZE))
+            if not batch:
+                if label:
+                    logger.info(f"Fetched {count} {label}")
+                return
+            count += len(batch)
+            yield ','.join(batch)
+    def generate(parts):
+        yield prefix + '['
+        for i, part in enumerate(parts):
+            yield part if i == 0 else ',' + part
+        yield ']' + suffix + '\n'
+    parts = chunks()
+    first = next(parts, None)
+    body = generate(chain([first], parts) if first is not None else iter(()))
+    return Response(body, status=status, mimetype='application/json')
+def paginate(cursor, sort_field='created_at'):
+    """Applies optional ?limit=&skip= query parameters to a find() cursor, newest first."""
+    limit = request.args.get('limit', type=int)
+    skip = request.args.get('skip', type=int)
+    if limit is None and skip is None:
+        return cursor
+    cursor.sort(sort_field, -1)
+    if skip:
+        cursor.skip(skip)
+    if limit:
+        cursor.limit(limit)
+    return cursor
 def get_system_settings():
     if settings_collection is None:
         logger.warning("Settings collection not available, returning default settings")
@@ -750,6 +3201,7 @@ def serve_uploaded_image(filename):
         return jsonify({"error": "Image not found"}), 404
 @app.route('/api/import-mongodb', methods=['POST', 'OPTIONS'])
 @db_required
+@transactional
 def import_mongodb():
     if request.method == 'OPTIONS':
         response = jsonify({"success": True})
@@ -783,7 +3235,7 @@ def import_mongodb():
         if not isinstance(data, list):
             logger.error("JSON data must be an array")
             return jsonify({"error": "JSON data must be an array"}), 400
-        inserted_count = 0
+        operations = []
         for record in data:
             if '_id' in record:
                 record['_id'] = str(record['_id'])
@@ -805,8 +3257,9 @@ def import_mongodb():
             if not unique_key:
                 logger.error(f"No unique key defined for record in collection {collection_name}")
                 return jsonify({"error": f"No unique key defined for record in collection {collection_name}"}), 400
-            target_collection.replace_one(unique_key, record, upsert=True)
-            inserted_count += 1
+            operations.append(ReplaceOne(unique_key, record, upsert=True))
+        target_collection.bulk_write(operations)
+        inserted_count = len(operations)
         logger.info(f"Imported {inserted_count} records into {collection_name}")
         return jsonify({"message": f"Successfully imported {inserted_count} records into {collection_name}"}), 200
     except json.JSONDecodeError as e:
@@ -920,6 +3373,100 @@ def send_email():
     except Exception as e:
         logger.error(f"Unexpected error sending email: {str(e)}")
         return jsonify({"success": False, "message": f"Failed to send email: {str(e)}"}), 500
+# --- Snapshots ---
+# create_snapshot() copies restaurant.db with the online backup API, SNAPSHOT_PAGES pages per step,
+# pausing between steps so other threads get the GIL and the disk. The source connection holds one read
+# transaction for the whole copy: in WAL mode writers carry on, and the copy is the database as of
+# its start. Exports read from a snapshot instead of the live database, so every sheet is consistent.
+SNAPSHOT_PAGES = 256
+SNAPSHOT_STEP_PAUSE = 0.001
+SNAPSHOT_DIR = os.path.join(CONFIG_DIR, 'snapshots')
+def create_snapshot(db_path, target_path, pages=SNAPSHOT_PAGES):
+    """Writes a consistent copy of the database at db_path to target_path and returns target_path."""
+    source = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    target = sqlite3.connect(target_path)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(SNAPSHOT_STEP_PAUSE))
+        source.rollback()
+    finally:
+        target.close()
+        source.close()
+    return target_path
+@contextmanager
+def database_snapshot(names=None):
+    """Takes a snapshot of the live database and its monthly archives and yields {name: SQLiteCollection} reading from it.
+
+    The collections bypass the document cache and read every archived month; the snapshot is deleted on exit."""
+    directory = os.path.join(SNAPSHOT_DIR, f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}")
+    archive_dir = os.path.join(directory, 'archive')
+    os.makedirs(archive_dir)
+    path = os.path.join(directory, os.path.basename(conn.db_path))
+    started = time.perf_counter()
+    snapshot = None
+    try:
+        with ARCHIVE_LOCK:
+            create_snapshot(conn.db_path, path)
+            snapshot = SQLiteConnectionPool(path)
+            snapshot.archive_dir = archive_dir
+            snapshot.archive_months = load_archive_catalog(snapshot)
+            for month in sorted({month for months in snapshot.archive_months.values() for month in months}):
+                create_snapshot(archive_path(month), archive_path(month, archive_dir))
+        logger.info(f"Created database snapshot {os.path.basename(directory)} in {time.perf_counter() - started:.2f}s")
+        yield {
+            name: SQLiteCollection(snapshot, name, cached=False, archived=True, stats_name=f"snapshot.{name}")
+            for name in (names or EXPORT_COLLECTIONS)
+        }
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        shutil.rmtree(directory, ignore_errors=True)
+EXPORT_COLLECTIONS = (
+    'active_orders',
+    'combo_offers',
+    'customers',
+    'email_settings',
+    'email_tokens',
+    'employees',
+    'item_groups',
+    'items',
+    'kitchen_saved_orders',
+    'kitchens',
+    'order_counters',
+    'picked_up_items',
+    'pos_closing_entries',
+    'pos_opening_entries',
+    'print_settings',
+    'purchase_invoices',
+    'purchase_items',
+    'purchase_orders',
+    'purchase_receipts',
+    'purchase_sales',
+    'sales',
+    'suppliers',
+    'system_settings',
+    'tables',
+    'trip_reports',
+    'uoms',
+    'users',
+    'variants',
+    'vat',
+    'customer_groups',
+)
+EXPORT_BATCH_SIZE = 200
+def write_collection_sheet(wb, collection_name, collection):
+    """Streams one collection into a new sheet; headers come from the first document."""
+    ws = wb.create_sheet(title=collection_name)
+    headers = None
+    for doc in collection.find().batch_size(EXPORT_BATCH_SIZE):
+        if headers is None:
+            headers = list(doc.keys())
+            ws.append(headers)
+        row = [str(doc.get(header, '')) if isinstance(doc.get(header), (list, dict)) else doc.get(header, '') for header in headers]
+        ws.append(row)
+    if headers is None:
+        ws.append(['No data'])
 @app.route('/api/export-all-to-excel', methods=['GET'])
 @db_required
 def export_all_to_excel():
@@ -928,52 +3475,10 @@ def export_all_to_excel():
         if openpyxl is None:
             logger.error("openpyxl not installed")
             return jsonify({"error": "Excel export not available. Please install openpyxl library."}), 500
-        wb = openpyxl.Workbook()
-        wb.remove(wb.active)
-        collections = {
-            'active_orders': activeorders_collection,
-            'combo_offers': combo_offers_collection,
-            'customers': customers_collection,
-            'email_settings': email_settings_collection,
-            'email_tokens': email_tokens_collection,
-            'employees': employees_collection,
-            'item_groups': item_groups_collection,
-            'items': items_collection,
-            'kitchen_saved_orders': kitchen_saved_collection,
-            'kitchens': kitchens_collection,
-            'order_counters': order_counters_collection,
-            'picked_up_items': picked_up_collection,
-            'pos_closing_entries': pos_closing_collection,
-            'pos_opening_entries': opening_collection,
-            'print_settings': print_settings_collection,
-            'purchase_invoices': purchase_invoices_collection,
-            'purchase_items': purchase_items_collection,
-            'purchase_orders': purchase_orders_collection,
-            'purchase_receipts': purchase_receipts_collection,
-            'purchase_sales': purchase_sales_collection,
-            'sales': sales_collection,
-            'suppliers': suppliers_collection,
-            'system_settings': settings_collection,
-            'tables': tables_collection,
-            'trip_reports': tripreports_collection,
-            'uoms': uoms_collection,
-            'users': users_collection,
-            'variants': variants_collection,
-            'vat': vat_collection,
-            'customer_groups': customer_groups_collection  # NEW: customer_groups
-        }
-        for collection_name, collection in collections.items():
-            ws = wb.create_sheet(title=collection_name)
-            data = collection.find()
-            if not data:
-                ws.append(['No data'])
-                continue
-            sample_doc = data[0]
-            headers = list(sample_doc.keys())
-            ws.append(headers)
-            for doc in data:
-                row = [str(doc.get(header, '')) if isinstance(doc.get(header), (list, dict)) else doc.get(header, '') for header in headers]
-                ws.append(row)
+        wb = openpyxl.Workbook(write_only=True)
+        with database_snapshot() as snapshot:
+            for collection_name, collection in snapshot.items():
+                write_collection_sheet(wb, collection_name, collection)
         buffer = BytesIO()
         wb.save(buffer)
         buffer.seek(0)
@@ -1004,52 +3509,10 @@ def create_backup():
     try:
         if openpyxl is None:
             return False, "Excel library not available. Please install openpyxl."
-        wb = openpyxl.Workbook()
-        wb.remove(wb.active)
-        collections = {
-            'active_orders': activeorders_collection,
-            'combo_offers': combo_offers_collection,
-            'customers': customers_collection,
-            'email_settings': email_settings_collection,
-            'email_tokens': email_tokens_collection,
-            'employees': employees_collection,
-            'item_groups': item_groups_collection,
-            'items': items_collection,
-            'kitchen_saved_orders': kitchen_saved_collection,
-            'kitchens': kitchens_collection,
-            'order_counters': order_counters_collection,
-            'picked_up_items': picked_up_collection,
-            'pos_closing_entries': pos_closing_collection,
-            'pos_opening_entries': opening_collection,
-            'print_settings': print_settings_collection,
-            'purchase_invoices': purchase_invoices_collection,
-            'purchase_items': purchase_items_collection,
-            'purchase_orders': purchase_orders_collection,
-            'purchase_receipts': purchase_receipts_collection,
-            'purchase_sales': purchase_sales_collection,
-            'sales': sales_collection,
-            'suppliers': suppliers_collection,
-            'system_settings': settings_collection,
-            'tables': tables_collection,
-            'trip_reports': tripreports_collection,
-            'uoms': uoms_collection,
-            'users': users_collection,
-            'variants': variants_collection,
-            'vat': vat_collection,
-            'customer_groups': customer_groups_collection  # NEW: customer_groups
-        }
-        for collection_name, collection in collections.items():
-            ws = wb.create_sheet(title=collection_name)
-            data = collection.find()
-            if not data:
-                ws.append(['No data'])
-                continue
-            sample_doc = data[0]
-            headers = list(sample_doc.keys())
-            ws.append(headers)
-            for doc in data:
-                row = [str(doc.get(header, '')) if isinstance(doc.get(header), (list, dict)) else doc.get(header, '') for header in headers]
-                ws.append(row)
+        wb = openpyxl.Workbook(write_only=True)
+        with database_snapshot() as snapshot:
+            for collection_name, collection in snapshot.items():
+                write_collection_sheet(wb, collection_name, collection)
         buffer = BytesIO()
         wb.save(buffer)
         buffer.seek(0)
@@ -1155,6 +3618,39 @@ def download_backup():
     except Exception as e:
         logger.error(f"Error downloading backup {filename}: {str(e)}")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
+@app.route('/api/changes', methods=['GET'])
+@db_required
+def get_changes():
+    """Lists change log entries after ?since=<seq>, optionally for some ?collection= only."""
+    try:
+        since = request.args.get('since', 0, type=int)
+        limit = min(request.args.get('limit', CHANGE_LOG_PAGE, type=int), CHANGE_LOG_PAGE)
+        result = changes_since(conn, since, request.args.getlist('collection') or None, limit)
+        return jsonify({
+            'changes': result.changes,
+            'last_seq': result.last_seq,
+            'has_more': result.has_more,
+            'resync': result.resync
+        }), 200
+    except Exception as e:
+        logger.error(f"Error retrieving changes: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+@app.route('/api/debug/db-stats', methods=['GET', 'DELETE'])
+@db_required
+def get_db_stats():
+    """Per collection and method database counters since the last reset; DELETE or ?reset=1 resets them."""
+    try:
+        stats = {
+            'since': DB_STATS.since,
+            'collections': DB_STATS.report(),
+            'caches': {name: cache.info() for name, cache in DOCUMENT_CACHES.items()}
+        }
+        if request.method == 'DELETE' or request.args.get('reset') in ('1', 'true'):
+            DB_STATS.reset()
+        return jsonify(stats), 200
+    except Exception as e:
+        logger.error(f"Error retrieving database statistics: {str(e)}")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
 @app.route('/api/get-backup-interval', methods=['GET'])
 @db_required
 def get_backup_interval():
@@ -1412,6 +3908,19 @@ if config.get('mode') == 'server':
         except Exception as e:
             logger.error(f"Error fetching items: {str(e)}\n{traceback.format_exc()}")
             return jsonify({"error": str(e)}), 500
+    @app.route('/api/items/search', methods=['GET'])
+    @db_required
+    def search_items():
+        try:
+            if not MENU_SEARCH_AVAILABLE:
+                return jsonify({"error": "Menu search is not available"}), 503
+            text = request.args.get('q', '')
+            limit = min(max(request.args.get('limit', MENU_SEARCH_LIMIT, type=int), 1), 100)
+            results = search_menu(conn, text, request.args.getlist('type') or None, limit)
+            return jsonify(results), 200
+        except Exception as e:
+            logger.error(f"Error searching items: {str(e)}")
+            return jsonify({"error": str(e)}), 500
     @app.route('/api/items/<identifier>', methods=['GET'])
     @db_required
     def get_item(identifier):
@@ -1604,10 +4113,7 @@ if config.get('mode') == 'server':
     @db_required
     def get_all_customers():
         try:
-            customers = customers_collection.find()
-            customers = convert_objectid_to_str(customers)
-            logger.info(f"Fetched {len(customers)} customers")
-            return jsonify(customers), 200
+            return json_array_response(customers_collection.find_raw(), label='customers')
         except Exception as e:
             logger.error(f"Error fetching customers: {str(e)}")
             return jsonify({"error": str(e)}), 500
@@ -1837,9 +4343,8 @@ if config.get('mode') == 'server':
     @db_required
     def get_all_sales():
         try:
-            sales = sales_collection.find()
+            sales = paginate(sales_collection.find({'status': {'$ne': 'Cancelled'}}))
             sales = convert_objectid_to_str(sales)
-            sales = [sale for sale in sales if sale.get('status') != 'Cancelled']
             logger.info(f"Fetched {len(sales)} sales invoices")
             return jsonify(sales), 200
         except Exception as e:
@@ -1988,6 +4493,7 @@ if config.get('mode') == 'server':
             return jsonify({"error": str(e)}), 500
     @app.route('/api/create_opening_entry', methods=['POST'])
     @db_required
+    @transactional
     def create_opening_entry():
         try:
             data = request.get_json()
@@ -2051,11 +4557,14 @@ if config.get('mode') == 'server':
             if not opening_entry:
                 return jsonify({"message": "Opening entry not found", "status": "error"}), 404
             period_start = opening_entry['period_start_date']
-            invoices = sales_collection.find({"date": {"$gte": period_start}})
+            period = {"$match": {"date": {"$gte": period_start}}}
+            invoices = sales_collection.find(period["$match"], {'invoice_no': 1, 'grand_total': 1, 'date': 1, 'customer': 1})
             invoices = convert_objectid_to_str(invoices)
-            total = sum(float(inv['grand_total']) for inv in invoices)
-            net_total = sum(float(inv['total']) for inv in invoices)
-            total_qty = sum(sum(item['quantity'] for item in inv['items']) for inv in invoices)
+            totals = sales_collection.aggregate([period, {"$group": {"_id": None, "grand_total": {"$sum": "$grand_total"}, "net_total": {"$sum": "$total"}}}])
+            quantities = sales_collection.aggregate([period, {"$unwind": "$items"}, {"$group": {"_id": None, "quantity": {"$sum": "$items.quantity"}}}])
+            total = float(totals[0]['grand_total']) if totals else 0
+            net_total = float(totals[0]['net_total']) if totals else 0
+            total_qty = quantities[0]['quantity'] if quantities else 0
             vat_settings = vat_collection.find_one({"_id": "vat_settings"})
             vat_percentage = vat_settings.get("vat", 10) if vat_settings else 10
             taxes = [{"account_head": "VAT", "rate": vat_percentage, "amount": total - net_total}]
@@ -2598,13 +5107,13 @@ if config.get('mode') == 'server':
     @db_required
     def get_employees():
         try:
-            employees = employees_collection.find()
-            return jsonify(convert_objectid_to_str(employees)), 200
+            return json_array_response(employees_collection.find_raw())
         except Exception as e:
             logger.error(f"Error fetching employees: {str(e)}")
             return jsonify({'error': str(e)}), 500
     @app.route('/api/employees', methods=['POST'])
     @db_required
+    @transactional
     def create_employee():
         try:
             data = request.get_json()
@@ -2646,6 +5155,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': str(e)}), 500
     @app.route('/api/employees/<employee_id>', methods=['PUT'])
     @db_required
+    @transactional
     def update_employee(employee_id):
         try:
             data = request.get_json()
@@ -2694,6 +5204,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': str(e)}), 500
     @app.route('/api/employees/<employee_id>', methods=['DELETE'])
     @db_required
+    @transactional
     def delete_employee(employee_id):
         try:
             employee = employees_collection.find_one({'employeeId': employee_id})
@@ -2714,7 +5225,7 @@ if config.get('mode') == 'server':
     @db_required
     def get_trip_reports(employee_id):
         try:
-            trip_reports = tripreports_collection.find({'deliveryPersonId': employee_id})
+            trip_reports = paginate(tripreports_collection.find({'deliveryPersonId': employee_id}))
             return jsonify(convert_objectid_to_str(trip_reports)), 200
         except Exception as e:
             logger.error(f"Error fetching trip reports: {str(e)}")
@@ -2776,8 +5287,7 @@ if config.get('mode') == 'server':
     @db_required
     def get_purchase_items():
         try:
-            items = purchase_items_collection.find()
-            return jsonify(convert_objectid_to_str(items)), 200
+            return json_array_response(purchase_items_collection.find_raw())
         except Exception as e:
             return jsonify({'error': f"Failed to fetch items: {str(e)}"}), 500
     @app.route('/api/purchase_items', methods=['POST'])
@@ -3069,6 +5579,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': f"Failed to fetch purchase receipts: {str(e)}"}), 500
     @app.route('/api/purchase_receipts', methods=['POST'])
     @db_required
+    @transactional
     def add_purchase_receipt():
         try:
             data = request.json
@@ -3146,6 +5657,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': f"Failed to create purchase receipt: {str(e)}"}), 500
     @app.route('/api/purchase_receipts/<series>', methods=['PUT'])
     @db_required
+    @transactional
     def update_purchase_receipt(series):
         try:
             data = request.json
@@ -3239,6 +5751,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': f"Failed to update purchase receipt: {str(e)}"}), 500
     @app.route('/api/purchase_receipts/<series>', methods=['DELETE'])
     @db_required
+    @transactional
     def delete_purchase_receipt(series):
         try:
             old_receipt = purchase_receipts_collection.find_one({'series': series})
@@ -3277,12 +5790,13 @@ if config.get('mode') == 'server':
     @db_required
     def get_purchase_invoices():
         try:
-            invoices = purchase_invoices_collection.find()
+            invoices = paginate(purchase_invoices_collection.find())
             return jsonify(convert_objectid_to_str(invoices)), 200
         except Exception as e:
             return jsonify({'error': f"Failed to fetch purchase invoices: {str(e)}"}), 500
     @app.route('/api/purchase_invoices', methods=['POST'])
     @db_required
+    @transactional
     def add_purchase_invoice():
         try:
             data = request.json
@@ -3345,6 +5859,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': f"Failed to create purchase invoice: {str(e)}"}), 500
     @app.route('/api/purchase_invoices/<series>', methods=['PUT'])
     @db_required
+    @transactional
     def update_purchase_invoice(series):
         try:
             data = request.json
@@ -3413,6 +5928,7 @@ if config.get('mode') == 'server':
             return jsonify({'error': f"Failed to fetch sales: {str(e)}"}), 500
     @app.route('/api/purchase_sales', methods=['POST'])
     @db_required
+    @transactional
     def add_purchase_sale():
         try:
             data = request.json
@@ -3495,6 +6011,7 @@ if config.get('mode') == 'server':
             return jsonify({"message": "Print settings deleted successfully"}), 200
     @app.route('/api/print_settings/set_active/<id>', methods=['PUT'])
     @db_required
+    @transactional
     def set_active_print_settings(id):
         try:
             print_settings_collection.update_many({}, {"$set": {"active": False}})
@@ -3709,7 +6226,11 @@ def manage_offers():
     """Check all items and update offer status based on current time."""
     try:
         current_time = datetime.now(ZoneInfo("UTC"))
-        items = items_collection.find()
+        items = items_collection.find(
+            {'offer_end_time': {'$nin': [None, '']}},
+            {'item_name': 1, 'offer_start_time': 1, 'offer_end_time': 1}
+        )
+        expired_ids = []
         for item in items:
             item_id = item['_id']
             offer_start_time = item.get('offer_start_time')
@@ -3740,18 +6261,20 @@ def manage_offers():
                     logger.warning(f"Invalid offer_end_time for item {item_id}: {str(e)}")
                     should_unset = True
             if should_unset:
-                items_collection.update_one(
-                    {'_id': item_id},
-                    {'$unset': {'offer_price': "", 'offer_start_time': "", 'offer_end_time': ""}}
-                )
+                expired_ids.append(item_id)
                 logger.info(f"Unset offer fields for item {item.get('item_name')} (ID: {item_id})")
+        if expired_ids:
+            items_collection.update_many_by_ids(
+                expired_ids,
+                {'$unset': {'offer_price': "", 'offer_start_time': "", 'offer_end_time': ""}}
+            )
     except Exception as e:
         logger.error(f"Error in manage_offers: {str(e)}")
 def manage_combo_offers():
     """Check all combo offers and delete them when end time is reached."""
     try:
         current_time = datetime.now(ZoneInfo("UTC"))
-        offers = combo_offers_collection.find()
+        offers = combo_offers_collection.find({'offer_end_time': {'$nin': [None, '']}}, {'offer_end_time': 1})
         for offer in offers:
             offer_id = offer['_id']
             offer_end_time = offer.get('offer_end_time')
@@ -3769,6 +6292,9 @@ def schedule_tasks():
     if schedule:
         schedule.every(1).minutes.do(manage_offers)
         schedule.every(1).minutes.do(manage_combo_offers)
+        schedule.every().day.at("03:00").do(compress_cold_collections)
+        schedule.every().day.at("03:30").do(archive_old_collections)
+        schedule.every().day.at("04:00").do(compact_change_log_job)
         while True:
             schedule.run_pending()
             time.sleep(1)
@@ -3847,16 +6373,15 @@ def manage_company_details():
 def generate_order_number(order_type):
     if order_counters_collection is None:
         raise Exception("Database not initialized correctly. Order counters collection is missing.")
-    counter_doc = order_counters_collection.find_one_and_update(
-        {'_id': order_type},
-        {'$inc': {'count': 1}},
-        upsert=True,
-        return_document=True
-    )
-    return f"{order_type}-{counter_doc['count']:04d}"
+    counter_id = order_type
+    if config.get('order_number_reset') == 'daily':
+        counter_id = f"{order_type}:{datetime.now().strftime('%Y-%m-%d')}"
+    count = order_counters_collection.next_sequence(counter_id)
+    return f"{order_type}-{count:04d}"
 
 @app.route('/api/activeorders', methods=['POST'])
 @db_required
+@transactional
 def save_active_order():
     try:
         data = request.get_json()
@@ -3911,8 +6436,7 @@ def save_active_order():
 @db_required
 def get_active_orders():
     try:
-        orders = activeorders_collection.find()
-        return jsonify(convert_objectid_to_str(list(orders))), 200
+        return json_array_response(activeorders_collection.find_raw())
     except Exception as e:
         logger.error(f"Error fetching active orders: {str(e)}")
         logger.error(traceback.format_exc())
@@ -3920,6 +6444,7 @@ def get_active_orders():
 
 @app.route('/api/activeorders/<order_id>/items/<item_id>/mark-prepared', methods=['POST'])
 @db_required
+@transactional
 def mark_item_prepared_active(order_id, item_id):
     try:
         data = request.get_json()
@@ -3952,6 +6477,7 @@ def mark_item_prepared_active(order_id, item_id):
 
 @app.route('/api/activeorders/<order_id>/items/<item_id>/mark-pickedup', methods=['POST'])
 @db_required
+@transactional
 def mark_item_pickedup_active(order_id, item_id):
     try:
         data = request.get_json()
@@ -3997,6 +6523,7 @@ def mark_item_pickedup_active(order_id, item_id):
 
 @app.route('/api/activeorders/<order_id>/items/<item_id>/mark-served', methods=['POST'])
 @db_required
+@transactional
 def mark_item_served(order_id, item_id):
     try:
         data = request.get_json()
@@ -4027,6 +6554,7 @@ def mark_item_served(order_id, item_id):
 
 @app.route('/api/activeorders/<order_id>/items/<item_id>', methods=['DELETE'])
 @db_required
+@transactional
 def delete_order_item(order_id, item_id):
     try:
         for collection in [activeorders_collection, kitchen_saved_collection]:
@@ -4047,6 +6575,7 @@ def delete_order_item(order_id, item_id):
 
 @app.route('/api/activeorders/<order_id>', methods=['PUT'])
 @db_required
+@transactional
 def update_active_order(order_id):
     try:
         data = request.get_json()
@@ -4139,6 +6668,7 @@ def update_active_order(order_id):
 
 @app.route('/api/activeorders/<order_id>', methods=['DELETE'])
 @db_required
+@transactional
 def delete_order(order_id):
     try:
         result = activeorders_collection.delete_one({'orderId': order_id})
@@ -4155,6 +6685,7 @@ def delete_order(order_id):
 
 @app.route('/api/kitchen-saved', methods=['POST'])
 @db_required
+@transactional
 def save_kitchen_order():
     try:
         data = request.get_json()
@@ -4214,8 +6745,7 @@ def save_kitchen_order():
 @db_required
 def get_kitchen_orders():
     try:
-        orders = kitchen_saved_collection.find()
-        return jsonify({'success': True, 'orders': convert_objectid_to_str(list(orders))}), 200
+        return json_array_response(kitchen_saved_collection.find_raw(), prefix='{"success": true, "orders": ', suffix='}')
     except Exception as e:
         logger.error(f"Error in /api/kitchen-saved GET: {str(e)}")
         logger.error(traceback.format_exc())
@@ -4238,6 +6768,7 @@ def delete_kitchen_order(order_id):
 
 @app.route('/api/kitchen-saved/<order_id>/items/<item_id>/mark-prepared', methods=['POST'])
 @db_required
+@transactional
 def mark_item_prepared(order_id, item_id):
     try:
         data = request.get_json()
@@ -0,0 +1,47 @@
+import copy
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app1 reads CONFIG_DIR and writes its log there at import time.
+os.environ.setdefault('CONFIG_DIR', tempfile.mkdtemp(prefix='pos-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app1 as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app1(tmp_path, monkeypatch):
+    """app1 connected to a fresh, empty database under tmp_path."""
+    monkeypatch.setattr(app_module, 'CONFIG_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(app_module, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.setitem(app_module.config, 'mode', 'server')
+    # Seeding the test users hashes passwords with bcrypt, which dominates connect time.
+    monkeypatch.setattr(app_module, 'ensure_test_users', lambda: None)
+    app_module.DOCUMENT_CACHES.clear()
+    app_module.ARCHIVE_MONTHS.clear()
+    app_module.COMPRESSION_DICTS.clear()
+    app_module.connect_to_sqlite()
+    yield app_module
+    app_module.conn.close()
+    app_module.conn = None
+
+
+@pytest.fixture
+def docs(app1, request):
+    """customers_collection seeded with copies of the test module's DOCS."""
+    collection = app1.customers_collection
+    collection.insert_many(copy.deepcopy(request.module.DOCS))
+    return collection
+
+
+def count_queries(app1, table):
+    """Returns a list collecting the document reads (SELECT id, ...) on table made by this thread's connection."""
+    statements = []
+    app1.conn.connection().set_trace_callback(
+        lambda sql: statements.append(sql) if sql.startswith('SELECT id') and f'FROM {table}' in sql else None
+    )
+    return statements
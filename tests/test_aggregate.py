@@ -0,0 +1,40 @@
+import pytest
+
+SALES = [
+    {'_id': f's{i}', 'date': f'2025-0{1 + i % 3}-1{i % 10}', 'status': ['paid', 'void', 'open'][i % 3],
+     'customer': f'c{i % 4}', 'total': i * 10, 'items': [{'item': 'a', 'qty': i}, {'item': 'b', 'qty': 1}]}
+    for i in range(12)
+]
+MATCHES = [
+    [{'$match': {'date': {'$gte': '2025-02-01'}}}, {'$match': {'date': {'$lt': '2025-03-01'}}}],
+    [{'$match': {'status': 'paid'}}, {'$match': {'status': {'$ne': 'void'}}}],
+    [{'$match': {'status': {'$in': ['paid', 'open']}}}, {'$match': {'customer': 'c1', 'total': {'$gt': 0}}}],
+]
+GROUP = [{'$group': {'_id': '$customer', 'total': {'$sum': '$total'}, 'count': {'$count': {}}}}, {'$sort': {'_id': 1}}]
+
+
+@pytest.fixture
+def sales(app1):
+    app1.sales_collection.insert_many([dict(d) for d in SALES])
+    return app1.sales_collection
+
+
+@pytest.mark.parametrize('index', range(len(MATCHES)))
+@pytest.mark.parametrize('group', [False, True])
+def test_consecutive_matches(app1, sales, index, group):
+    pipeline = MATCHES[index] + (GROUP if group else [])
+    assert app1.pipeline_plan(pipeline) is not None
+    result = sales.aggregate(pipeline)
+    expected = app1.aggregate_documents(sales.find(), pipeline)
+    assert result
+    if group:
+        assert result == expected
+    else:
+        assert sorted(d['_id'] for d in result) == sorted(d['_id'] for d in expected)
+
+
+def test_matches_merge_into_one_filter(app1):
+    plan = app1.pipeline_plan(MATCHES[0])
+    assert plan['$match'] == {'date': {'$gte': '2025-02-01', '$lt': '2025-03-01'}}
+    plan = app1.pipeline_plan(MATCHES[1])
+    assert plan['$match'] == {'$and': [{'status': 'paid'}, {'status': {'$ne': 'void'}}]}
@@ -0,0 +1,114 @@
+import os
+import threading
+
+import pytest
+
+MONTHS = ['2023-01', '2023-02', '2023-03', '2024-05', '2024-06', '2024-07', '2024-08', '2024-09', '2024-10', '2024-11', '2024-12']
+
+
+@pytest.fixture
+def archived_sales(app1):
+    sales = app1.sales_collection
+    sales.insert_many([{'_id': f'{month}-{n}', 'date': f'{month}-1{n}', 'grand_total': 10} for month in MONTHS for n in range(3)])
+    sales.insert_many([{'_id': f'live-{n}', 'date': f'2099-01-0{n}', 'grand_total': 10} for n in range(1, 4)])
+    assert app1.archive_documents(app1.conn, 'sales', 30) == 3 * len(MONTHS)
+    return sales
+
+
+def test_snapshot_exports_include_archived_months(app1, archived_sales):
+    assert archived_sales.count_documents({}) == 3
+    with app1.database_snapshot(['sales']) as snapshot:
+        sales = snapshot['sales']
+        assert sales.count_documents({}) == 3 * len(MONTHS) + 3
+        assert len(list(sales.find())) == 3 * len(MONTHS) + 3
+        assert sales.count_documents({'date': {'$gte': '2024-12-01'}}) == 6
+        directory = os.path.dirname(sales.conn.db_path)
+        assert sorted(os.listdir(os.path.join(directory, 'archive'))) == [f'{month}.db' for month in MONTHS]
+    assert not os.path.exists(directory)
+
+
+def test_snapshot_waits_for_archiver(app1, archived_sales):
+    taken = threading.Event()
+
+    def snapshot():
+        with app1.database_snapshot(['sales']):
+            taken.set()
+
+    with app1.ARCHIVE_LOCK:
+        worker = threading.Thread(target=snapshot)
+        worker.start()
+        assert not taken.wait(0.2)
+    worker.join(10)
+    assert taken.is_set()
+
+
+def test_reads_inside_transaction_see_recent_archives(app1, archived_sales):
+    app1.conn.close()
+    recent = {'date': {'$gte': '2024-05-01'}}
+    outside = archived_sales.count_documents(recent)
+    assert outside == 3 * 8 + 3
+    with app1.conn.transaction():
+        assert archived_sales.count_documents(recent) == outside
+        assert len(list(archived_sales.find(recent))) == outside
+
+
+def test_reads_inside_transaction_refuse_unattached_archives(app1, archived_sales):
+    app1.conn.close()
+    with pytest.raises(RuntimeError, match='2023-01 archive of sales inside a transaction'):
+        with app1.conn.transaction():
+            archived_sales.count_documents({'date': {'$gte': '2023-01-01', '$lt': '2023-02-01'}})
+    assert archived_sales.count_documents({'date': {'$gte': '2023-01-01', '$lt': '2023-02-01'}}) == 3
+
+
+def test_archiving_is_not_logged_as_a_delete(app1, archived_sales):
+    changes = app1.changes_since(app1.conn, 0, ['sales']).changes
+    assert changes and all(change['op'] == 'insert' for change in changes)
+    archived_sales.delete_one({'_id': 'live-1'})
+    assert app1.changes_since(app1.conn, 0, ['sales']).changes[-1]['op'] == 'delete'
+    assert app1.conn.execute("SELECT 1 FROM storage_meta WHERE key = 'archiving'").fetchone() is None
+
+
+@pytest.mark.parametrize('extra, update', [
+    ({}, {'$set': {'status': 'void'}}),
+    ({'tags': {'$ne': ['x']}}, {'$set': {'status': 'void'}}),
+    ({}, {'$set': {'status.code': 'void'}}),
+], ids=['in-place', 'residual-filter', 'python'])
+def test_updates_only_reach_live_documents(app1, archived_sales, extra, update):
+    recent = {'date': {'$gte': '2024-12-01'}, **extra}
+    assert archived_sales.count_documents(recent) == 6
+    result = archived_sales.update_many(recent, update)
+    assert (result.matched_count, result.modified_count) == (3, 3)
+    archived = {'_id': '2024-12-0', **recent}
+    assert archived_sales.update_one(archived, update).matched_count == 0
+    assert archived_sales.replace_one(archived, {'date': '2024-12-10'}).matched_count == 0
+    assert archived_sales.find_one(archived) == {'_id': '2024-12-0', 'date': '2024-12-10', 'grand_total': 10}
+    assert all('status' in sale for sale in archived_sales.find({'_id': {'$in': ['live-1', 'live-2', 'live-3']}}))
+
+
+def test_reads_over_many_archived_months(app1, archived_sales):
+    span = {'date': {'$gte': '2023-01-01'}}
+    dates = {f'{month}-{n}': f'{month}-1{n}' for month in MONTHS for n in range(3)}
+    dates.update({f'live-{n}': f'2099-01-0{n}' for n in range(1, 4)})
+    ids = sorted(dates)
+    assert len(archived_sales._archive_groups(span)) == 2
+    queries = []
+    app1.conn.connection().set_trace_callback(queries.append)
+    assert archived_sales.count_documents(span) == len(ids)
+    assert archived_sales.count_documents(span) == len(ids)
+    assert archived_sales._count(span, limit=10, skip=30) == 6
+    assert not any(sql.startswith('SELECT id') for sql in queries)
+    assert sum(sql.startswith('SELECT COUNT(*)') for sql in queries) == 6
+    app1.conn.connection().set_trace_callback(None)
+    assert len(archived_sales.find(span).skip(30).limit(10)) == 6
+    assert [d['_id'] for d in archived_sales.find(span).sort('date', -1)] == sorted(ids, key=dates.get, reverse=True)
+    assert [d['_id'] for d in archived_sales.find(span, {'_id': 1}).sort([('grand_total', 1), ('_id', -1)]).skip(2).limit(4)] == sorted(ids, reverse=True)[2:6]
+
+
+def test_unsorted_reads_stream_one_group_at_a_time(app1, archived_sales):
+    queries = []
+    app1.conn.connection().set_trace_callback(lambda sql: queries.append(sql) if sql.startswith('SELECT id') else None)
+    rows = iter(archived_sales.find({'date': {'$gte': '2023-01-01'}}))
+    assert next(rows)['_id'] == 'live-1'
+    assert len(queries) == 1
+    assert len(list(rows)) == 3 * len(MONTHS) + 2
+    assert len(queries) == 2
@@ -0,0 +1,50 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+
+def test_reimport_joins_request_transaction(app1, monkeypatch):
+    client = app1.app.test_client()
+    records = [{'_id': f'c{i}', 'name': f'name {i}', 'phone_number': f'p{i}'} for i in range(20000)]
+    data = json.dumps(records).encode()
+
+    def upload():
+        return client.post('/api/import-mongodb', data={'file': (io.BytesIO(data), 'db.customers.json')},
+                           content_type='multipart/form-data')
+
+    assert upload().status_code == 200
+    flushes, batches = [], []
+    flush, executemany = app1.BulkWriter.flush, app1.conn.executemany
+
+    def counting_flush(writer):
+        if writer.params:
+            flushes.append(len(writer.params))
+        flush(writer)
+
+    def counting_executemany(sql, rows):
+        batches.append(sql)
+        return executemany(sql, rows)
+
+    monkeypatch.setattr(app1.BulkWriter, 'flush', counting_flush)
+    monkeypatch.setattr(app1.conn, 'executemany', counting_executemany)
+    statements = []
+    app1.conn.connection().set_trace_callback(statements.append)
+    try:
+        assert upload().status_code == 200
+    finally:
+        app1.conn.connection().set_trace_callback(None)
+    assert not [sql for sql in statements if sql.startswith('SAVEPOINT')]
+    assert flushes == [20000]
+    assert len(batches) == 1 and batches[0].startswith('UPDATE customers')
+    assert app1.customers_collection.count_documents({}) == 20000
+
+
+def test_bulk_write_failure_rolls_back_enclosing_transaction(app1):
+    collection = app1.customers_collection
+    with pytest.raises(sqlite3.IntegrityError):
+        with app1.conn.transaction():
+            collection.insert_one({'_id': 'before'})
+            collection.bulk_write([app1.InsertOne({'_id': 'dup'}), app1.InsertOne({'_id': 'dup'})])
+    assert collection.count_documents({}) == 0
@@ -0,0 +1,26 @@
+import os
+
+
+def database_size(app1):
+    app1.conn.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(app1.conn.db_path)
+
+
+def test_compression_pass_shrinks_database_file(app1, monkeypatch):
+    items = [{'item_name': f'item {n}', 'quantity': n, 'basePrice': 10.0, 'kitchen': 'Main kitchen'} for n in range(40)]
+    app1.sales_collection.insert_many([
+        {'_id': f's{i}', 'invoice_no': f'INV-{i}', 'date': '2020-01-01', 'created_at': '2020-01-01T00:00:00+00:00', 'items': items}
+        for i in range(300)
+    ])
+    before = app1.sales_collection.find_one({'_id': 's7'})
+    size_before = database_size(app1)
+    monkeypatch.setitem(app1.config, 'compress_after_days', 30)
+    app1.compress_cold_collections()
+    assert app1.conn.execute("SELECT COUNT(*) FROM sales WHERE packed IS NOT NULL").fetchone()[0] == 300
+    assert database_size(app1) < size_before * 0.7
+    assert app1.sales_collection.find_one({'_id': 's7'}) == before
+
+
+def test_vacuum_skipped_inside_transaction(app1):
+    with app1.conn.transaction():
+        assert app1.vacuum_database(app1.conn) == 0
@@ -0,0 +1,20 @@
+from conftest import count_queries
+
+
+def test_list_of_find_runs_one_query(app1):
+    sales = app1.sales_collection
+    sales.insert_many([{'invoice_no': f'INV-{i}', 'date': '2025-10-01'} for i in range(5)])
+    statements = count_queries(app1, 'sales')
+    docs = list(sales.find({'date': '2025-10-01'}))
+    assert len(docs) == 5
+    assert len(statements) == 1
+
+
+def test_cursor_len_then_iterate_reuses_rows(app1):
+    sales = app1.sales_collection
+    sales.insert_many([{'invoice_no': f'INV-{i}'} for i in range(3)])
+    cursor = sales.find()
+    statements = count_queries(app1, 'sales')
+    assert len(cursor) == 3
+    assert [d['invoice_no'] for d in cursor] == ['INV-0', 'INV-1', 'INV-2']
+    assert len(statements) == 1
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from conftest import count_queries
+
+
+@pytest.fixture
+def items(app1):
+    collection = app1.items_collection
+    collection.insert_many([{'_id': f'i{n}', 'item_name': f'item {n}', 'price': n} for n in range(3)])
+    return collection
+
+
+def test_reads_are_served_from_cache_until_a_write(app1, items):
+    statements = count_queries(app1, 'items')
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+    assert len(statements) == 1
+    items.update_one({'_id': 'i1'}, {'$set': {'price': 10}})
+    assert items.find_one({'_id': 'i1'})['price'] == 10
+    assert len(statements) == 2
+
+
+def test_cached_documents_are_copies(app1, items):
+    items.find_one({'_id': 'i1'})['price'] = 99
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+
+
+def test_rolled_back_transaction_leaves_no_stale_entry(app1, items):
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+    with pytest.raises(RuntimeError):
+        with app1.conn.transaction():
+            items.update_one({'_id': 'i1'}, {'$set': {'price': 10}})
+            assert items.find_one({'_id': 'i1'})['price'] == 10
+            raise RuntimeError('abort')
+    assert items.cache_info()['entries'] == 0
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+
+
+def test_read_racing_a_write_is_not_cached(app1, items):
+    query = items._query
+
+    def query_then_write(*args, **kwargs):
+        rows = list(query(*args, **kwargs))
+        # Another thread commits a write after this read fetched its rows.
+        writer = threading.Thread(target=items.update_one, args=({'_id': 'i1'}, {'$set': {'price': 10}}))
+        writer.start()
+        writer.join()
+        return iter(rows)
+
+    items._query = query_then_write
+    assert items.find_one({'_id': 'i1'})['price'] == 1
+    assert items.cache_info()['entries'] == 0
+    del items._query
+    assert items.find_one({'_id': 'i1'})['price'] == 10
@@ -0,0 +1,87 @@
+import random
+
+import pytest
+
+DOCS = [
+    {'_id': 'f1', 'a': 1, 's': 'apple', 'n': None, 'o': {'x': 1, 'y': 'k'}, 'arr': [{'b': 1}, {'b': 2}], 'tags': ['x', 'y']},
+    {'_id': 'f2', 'a': 2.5, 's': 'banana', 'o': {'x': 3}, 'arr': [{'b': 3}], 'tags': []},
+    {'_id': 'f3', 'a': '2', 's': 'cherry', 'n': 0, 'o': {}, 'arr': []},
+    {'_id': 'f4', 's': None, 'o': {'x': None}, 'arr': [{'c': 1}]},
+    {'_id': 'f5', 'a': -3, 's': 'Apple', 'n': 'x', 'o': {'x': 2, 'y': 'z'}, 'arr': [{'b': None}, {'b': 2}], 'tags': ['y']},
+    {'_id': 'f6', 'a': 0, 'o': 5},
+]
+FIELDS = {
+    'a': [1, 2.5, '2', -3, 0, None, 10],
+    's': ['apple', 'banana', 'Apple', 'zzz', None],
+    'n': [None, 0, 'x'],
+    'o.x': [1, 2, 3, None],
+    'o.y': ['k', 'z', None],
+    'arr.b': [1, 2, 3, None],
+    'missing': [None, 1],
+}
+OPERATORS = ['$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists']
+
+
+def random_condition(rng):
+    field = rng.choice(list(FIELDS))
+    values = FIELDS[field]
+    op = rng.choice(OPERATORS)
+    if op in ('$in', '$nin'):
+        operand = rng.sample(values, rng.randint(0, min(3, len(values))))
+    elif op == '$exists':
+        operand = rng.choice([True, False])
+    else:
+        operand = rng.choice(values)
+    if op == '$eq' and rng.random() < 0.5:
+        return {field: operand}
+    return {field: {op: operand}}
+
+
+def random_filter(rng, depth=0):
+    filter_ = {}
+    for _ in range(rng.randint(1, 3)):
+        roll = rng.random()
+        if depth < 2 and roll < 0.15:
+            filter_.setdefault('$or', []).extend(random_filter(rng, depth + 1) for _ in range(rng.randint(1, 3)))
+        elif depth < 2 and roll < 0.3:
+            filter_.setdefault('$and', []).extend(random_filter(rng, depth + 1) for _ in range(rng.randint(1, 3)))
+        else:
+            for key, value in random_condition(rng).items():
+                if key not in filter_:
+                    filter_[key] = value
+    return filter_
+
+
+FILTERS = [random_filter(random.Random(seed)) for seed in range(300)] + [
+    {'$and': [{'a': {'$gte': 0}}, {'a': {'$lt': 2}}]},
+    {'$and': [{'s': {'$ne': None}}, {'$or': [{'o.x': 1}, {'arr.b': 3}]}]},
+    {'$and': []},
+]
+
+
+def python_ids(app1, filter_):
+    match = app1.compile_matcher(filter_)
+    return sorted(d['_id'] for d in DOCS if match(d))
+
+
+def test_sql_filters_match_compiled_matchers(app1, docs):
+    compiled_in_sql = 0
+    for filter_ in FILTERS:
+        clauses, params, residual = app1.compile_filter(filter_)
+        rows = app1.conn.execute(f"SELECT id FROM customers{app1.where_sql(clauses)}", params).fetchall()
+        sql_ids = sorted(row_id for row_id, in rows)
+        expected = python_ids(app1, filter_)
+        if residual is None:
+            compiled_in_sql += 1
+            assert sql_ids == expected, filter_
+        else:
+            assert set(expected) <= set(sql_ids), filter_
+        assert sorted(d['_id'] for d in docs.find(filter_)) == expected, filter_
+    assert compiled_in_sql > len(FILTERS) // 2
+
+
+def test_matchers_are_reused_by_shape(app1):
+    app1.FILTER_MATCHERS.clear()
+    assert app1.compile_matcher({'a': {'$gt': 1}, '$and': [{'s': 'x'}]})({'a': 2, 's': 'x'})
+    assert not app1.compile_matcher({'a': {'$gt': 5}, '$and': [{'s': 'x'}]})({'a': 2, 's': 'x'})
+    assert len(app1.FILTER_MATCHERS) == 1
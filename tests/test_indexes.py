@@ -0,0 +1,25 @@
+def reconnect(app1):
+    app1.conn.close()
+    app1.connect_to_sqlite()
+
+
+def test_runtime_index_survives_restart(app1):
+    name = app1.customers_collection.create_index('email')
+    reconnect(app1)
+    assert name in app1.customers_collection.index_information()
+
+
+def test_declared_indexes_still_built_and_undeclared_dropped(app1):
+    app1.conn.execute(f"CREATE INDEX {app1.MANAGED_INDEX_PREFIX}customers__stale ON customers (json_extract(data, '$.stale'))")
+    app1.conn.commit()
+    reconnect(app1)
+    indexes = app1.customers_collection.index_information()
+    assert app1.index_name('customers', ('phone_number',)) in indexes
+    assert f"{app1.MANAGED_INDEX_PREFIX}customers__stale" not in indexes
+
+
+def test_dropped_runtime_index_is_not_rebuilt(app1):
+    name = app1.customers_collection.create_index(['email', 'name'])
+    app1.customers_collection.drop_index(name)
+    reconnect(app1)
+    assert name not in app1.customers_collection.index_information()
@@ -0,0 +1,36 @@
+import pytest
+
+DOCS = [
+    {'_id': 'p1', 'a': 1, 'n': None, 'arr': [{'b': 2}, {'c': 3}, 7, {'b': None}], 'o': {'x': 1, 'y': {'z': 2}}},
+    {'_id': 'p2', 'a': 'text', 'arr': 'scalar', 'o': 5},
+    {'_id': 'p3'},
+]
+# (projection, {_id: expected document}); every projection is also checked against apply_projection().
+PROJECTIONS = [
+    ({'a': 1, 'zz': 1, 'arr.b': 1}, {
+        'p1': {'_id': 'p1', 'a': 1, 'arr': [{'b': 2}, {}, {'b': None}]},
+        'p2': {'_id': 'p2', 'a': 'text'},
+        'p3': {'_id': 'p3'},
+    }),
+    ({'n': 1}, {'p1': {'_id': 'p1', 'n': None}}),
+    ({'o.x': 1, 'o.y.z': 1, 'o.q': 1}, {'p1': {'_id': 'p1', 'o': {'x': 1, 'y': {'z': 2}}}, 'p2': {'_id': 'p2'}}),
+    ({'arr.b': 1, '_id': 0}, {}),
+    (['a', 'o'], {}),
+]
+
+
+@pytest.mark.parametrize('projection, expected', PROJECTIONS, ids=[str(projection) for projection, _ in PROJECTIONS])
+def test_sql_projection_matches_python(app1, docs, projection, expected):
+    spec = app1.parse_projection(projection)
+    for doc in DOCS:
+        from_sql = docs.find_one({'_id': doc['_id']}, projection)
+        from_python = app1.apply_projection(app1.copy_document(doc), spec)
+        assert from_sql == from_python
+        if doc['_id'] in expected:
+            assert from_sql == expected[doc['_id']]
+
+
+def test_missing_fields_are_left_out(docs):
+    doc = docs.find_one({'_id': 'p1'}, {'a': 1, 'zz': 1, 'arr.b': 1})
+    assert 'zz' not in doc
+    assert doc['arr'] == [{'b': 2}, {}, {'b': None}]
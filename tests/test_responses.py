@@ -0,0 +1,50 @@
+import json
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+
+import pytest
+
+
+def test_customer_list_streams_without_counting(app1, caplog):
+    app1.customers_collection.insert_many([{'_id': f'c{i}', 'customer_name': f'n{i}'} for i in range(3)])
+    statements = []
+    app1.conn.connection().set_trace_callback(statements.append)
+    with caplog.at_level(logging.INFO, logger=app1.logger.name):
+        response = app1.app.test_client().get('/api/customers')
+        body = response.get_json()
+    assert [d['_id'] for d in body] == ['c0', 'c1', 'c2']
+    assert not [sql for sql in statements if 'COUNT(' in sql.upper() and 'customers' in sql]
+    assert 'Fetched 3 customers' in caplog.text
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+class Markup:
+    def __html__(self):
+        return '<b>x</b>'
+
+
+def test_jsonify_uses_the_codec(app1, monkeypatch):
+    calls = []
+    dumps = app1.dumps_json_args
+    monkeypatch.setattr(app1, 'dumps_json_args', lambda *args, **kwargs: calls.append(kwargs) or dumps(*args, **kwargs))
+    token = uuid.UUID(int=1)
+    value = {'b': token, 'a': datetime(2024, 1, 2, 3, 4, 5), 'c': Markup(), 'd': Point(1, 2), 'e': {3, 4}}
+    with app1.app.test_request_context():
+        body = app1.jsonify(value).get_data(as_text=True)
+    assert calls
+    assert json.loads(body) == {'a': '2024-01-02T03:04:05', 'b': str(token), 'c': '<b>x</b>', 'd': {'x': 1, 'y': 2}, 'e': [3, 4]}
+    assert list(json.loads(body)) == ['a', 'b', 'c', 'd', 'e']
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'sort_keys': True}, {'indent': 2}, {'sort_keys': True, 'indent': 2}, {'indent': 4}])
+def test_dumps_json_args_matches_json_dumps(app1, kwargs):
+    value = {'z': [1, 2.5, None, 'é'], 'a': {'y': True, 'b': 'x'}}
+    ordered = lambda text: json.loads(text, object_pairs_hook=list)
+    assert ordered(app1.dumps_json_args(value, **kwargs)) == ordered(json.dumps(value, **kwargs))
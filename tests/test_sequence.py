@@ -0,0 +1,28 @@
+import threading
+
+import pytest
+
+
+@pytest.mark.parametrize('returning', [True, False], ids=['returning', 'upsert-then-select'])
+def test_concurrent_callers_get_unique_numbers(app1, monkeypatch, returning):
+    monkeypatch.setattr(app1, 'SQLITE_HAS_RETURNING', returning and app1.SQLITE_HAS_RETURNING)
+    counters = app1.order_counters_collection
+    numbers, errors = [], []
+    start = threading.Barrier(8)
+
+    def draw():
+        start.wait()
+        try:
+            for _ in range(25):
+                numbers.append(counters.next_sequence('dine-in'))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=draw) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors
+    assert sorted(numbers) == list(range(1, 201))
+    assert counters.find_one({'_id': 'dine-in'}) == {'_id': 'dine-in', 'count': 200}
@@ -0,0 +1,12 @@
+def test_snapshot_reads_are_counted_apart(app1):
+    app1.customers_collection.insert_many([{'_id': f'c{i}'} for i in range(3)])
+    app1.DB_STATS.reset()
+    assert len(list(app1.customers_collection.find())) == 3
+    with app1.database_snapshot(['customers']) as snapshot:
+        assert len(list(snapshot['customers'].find())) == 3
+        assert snapshot['customers'].count_documents({}) == 3
+    report = app1.DB_STATS.report()
+    assert report['customers']['find']['rows_returned'] == 3
+    assert 'count_documents' not in report['customers']
+    assert report['snapshot.customers']['find']['rows_returned'] == 3
+    assert report['snapshot.customers']['count_documents']['calls'] == 1
@@ -0,0 +1,26 @@
+import pytest
+
+from app1 import SQLITE_HAS_JSONB
+
+
+def reconnect(app1, monkeypatch, storage_format):
+    app1.conn.close()
+    monkeypatch.setitem(app1.config, 'storage_format', storage_format)
+    app1.connect_to_sqlite()
+
+
+@pytest.mark.skipif(not SQLITE_HAS_JSONB, reason='JSONB needs SQLite 3.45+')
+def test_conversion_rewrites_archived_months(app1, monkeypatch):
+    monkeypatch.setattr(app1, 'STORAGE_FORMAT', app1.STORAGE_FORMAT)
+    reconnect(app1, monkeypatch, 'jsonb')
+    app1.sales_collection.insert_many([{'_id': f's{n}', 'date': f'2023-0{n}-15', 'grand_total': n} for n in range(1, 4)])
+    assert app1.archive_documents(app1.conn, 'sales', 30) == 3
+    span = {'date': {'$gte': '2023-01-01'}}
+    for storage_format, stored_type in [('text', 'text'), ('jsonb', 'blob')]:
+        reconnect(app1, monkeypatch, storage_format)
+        sales = app1.sales_collection
+        assert sorted((d['_id'], d['grand_total']) for d in sales.find(span)) == [('s1', 1), ('s2', 2), ('s3', 3)]
+        for month in ('2023-01', '2023-02', '2023-03'):
+            app1.conn.attach(app1.archive_path(month), app1.archive_schema(month))
+            schema = app1.archive_schema(month)
+            assert app1.conn.execute(f"SELECT DISTINCT typeof(data) FROM {schema}.sales").fetchall() == [(stored_type,)]
@@ -0,0 +1,62 @@
+SALES = [
+    {'_id': 's1', 'date': '2025-10-01', 'status': 'Paid', 'items': [{'item_name': 'tea', 'quantity': 2, 'basePrice': 1.5},
+                                                                     {'item_name': 'cake', 'quantity': 1, 'basePrice': 4.0}]},
+    {'_id': 's2', 'date': '2025-10-05', 'status': 'Paid', 'items': [{'item_name': 'tea', 'quantity': 3, 'basePrice': 1.5}]},
+    {'_id': 's3', 'date': '2025-11-02', 'status': 'Cancelled', 'items': []},
+    {'_id': 's4', 'date': 20251003, 'status': 'Paid', 'items': [{'item_name': 'tea', 'quantity': 5}]},
+]
+
+
+def insert_sales(app1):
+    app1.sales_collection.insert_many([dict(d) for d in SALES])
+    return app1.sales_collection
+
+
+def query_plan(app1, statements):
+    return [row[-1] for sql in statements for row in app1.conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def test_sales_date_uses_typed_column_index(app1):
+    sales = insert_sales(app1)
+    indexes = app1.list_indexes(app1.conn.connection(), 'sales')['sales']
+    assert 'ix_col_sales__date' in indexes and 'ix_json_sales__date' not in indexes
+    statements = []
+    app1.conn.connection().set_trace_callback(statements.append)
+    found = [d['_id'] for d in sales.find({'date': {'$gte': '2025-10-01', '$lt': '2025-11-01'}})]
+    app1.conn.connection().set_trace_callback(None)
+    assert found == ['s1', 's2']
+    assert any('ix_col_sales__date' in step for step in query_plan(app1, statements))
+    assert sales.count_documents({'date': {'$in': ['2025-11-02', '20251003']}}) == 1
+    assert sales.count_documents({'status': 'Paid', 'date': {'$gt': '2025-10-01'}}) == 1
+
+
+def test_unwind_reports_read_line_items(app1):
+    sales = insert_sales(app1)
+    pipeline = [
+        {'$match': {'date': {'$gte': '2025-10-01'}}},
+        {'$unwind': '$items'},
+        {'$group': {'_id': '$items.item_name', 'quantity': {'$sum': '$items.quantity'}, 'price': {'$max': '$items.basePrice'}}},
+        {'$sort': {'_id': 1}},
+    ]
+    statements = []
+    app1.conn.connection().set_trace_callback(statements.append)
+    result = sales.aggregate(pipeline)
+    app1.conn.connection().set_trace_callback(None)
+    assert any('sales_line_items' in sql for sql in statements)
+    assert result == app1.aggregate_documents(sales.find(), pipeline)
+    assert result == [{'_id': 'cake', 'quantity': 1, 'price': 4.0}, {'_id': 'tea', 'quantity': 5, 'price': 1.5}]
+    assert isinstance(result[1]['quantity'], int)
+    counted = [{'$unwind': '$items'}, {'$group': {'_id': '$status', 'n': {'$count': {}}}}, {'$sort': {'_id': 1}}]
+    assert sales.aggregate(counted) == app1.aggregate_documents(sales.find(), counted) == [{'_id': 'Paid', 'n': 4}]
+
+
+def test_line_items_table_rebuilt_when_column_types_change(app1):
+    insert_sales(app1)
+    connection = app1.conn.connection()
+    connection.execute("DROP TABLE sales_line_items")
+    connection.execute("CREATE TABLE sales_line_items (parent_id TEXT NOT NULL, position INTEGER NOT NULL, item_name TEXT, "
+                       "quantity REAL, basePrice REAL, amount REAL, kitchen TEXT, PRIMARY KEY (parent_id, position))")
+    app1.ensure_typed_schema(connection)
+    types = {row[1]: row[2] for row in connection.execute("PRAGMA table_info(sales_line_items)")}
+    assert types['quantity'] == 'NUMERIC'
+    assert connection.execute("SELECT SUM(quantity) FROM sales_line_items").fetchone()[0] == 11
@@ -0,0 +1,41 @@
+import copy
+
+import pytest
+
+DOCS = [
+    {'_id': 'u1', 'qty': 5, 'price': 1.5, 'name': 'a', 'tags': ['x']},
+    {'_id': 'u2', 'qty': 0, 'name': 'b'},
+    {'_id': 'u3', 'name': 'c', 'old': True},
+]
+UPDATES = [
+    {'$inc': {'qty': 2}},
+    {'$inc': {'qty': -1, 'price': 0.25}},
+    {'$set': {'name': 'z', 'meta': {'k': [1, 2]}}, '$unset': {'tags': ''}},
+    {'$set': {'qty': None}, '$unset': {'old': ''}},
+    {'$inc': {'missing': 3}},
+]
+
+
+@pytest.mark.parametrize('update', UPDATES, ids=str)
+def test_in_place_update_matches_python(app1, docs, update):
+    assert app1.compile_update(update) is not None
+    docs.update_many({}, update)
+    for doc in DOCS:
+        expected = copy.deepcopy(doc)
+        app1.apply_update(expected, update)
+        assert docs.find_one({'_id': doc['_id']}) == expected
+
+
+@pytest.mark.parametrize('stored', ['5', None, [1], {'n': 1}], ids=repr)
+def test_inc_on_non_numeric_value_raises(app1, docs, stored):
+    docs.update_one({'_id': 'u1'}, {'$set': {'qty': stored}})
+    with pytest.raises(TypeError):
+        app1.apply_update({'qty': copy.deepcopy(stored)}, {'$inc': {'qty': 1}})
+    with pytest.raises(TypeError):
+        docs.update_one({'_id': 'u1'}, {'$inc': {'qty': 1}})
+    with pytest.raises(TypeError):
+        docs.update_many({}, {'$inc': {'qty': 1}})
+    with pytest.raises(TypeError):
+        docs.update_many_by_ids(['u1', 'u2'], {'$inc': {'qty': 1}})
+    assert docs.find_one({'_id': 'u1'})['qty'] == stored
+    assert docs.find_one({'_id': 'u2'})['qty'] == 0